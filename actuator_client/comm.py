@@ -1,8 +1,72 @@
+import asyncio
+import collections
+import json
+import socket
 import threading
+import traceback
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, Optional
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Deque,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+    TypeVar,
+    Union,
+)
 
 import zmq
+import zmq.asyncio
+
+# Channels are hierarchical: a message sent on "actuator/gate" is delivered to
+# the callback registered for "actuator/gate", or failing that "actuator".
+CHANNEL_SEPARATOR = "/"
+
+# Ends the channel frame, so that a subscription to "sensor:" and "sensor/"
+# matches the channel "sensor" and its sub-topics but not e.g. "sensors".
+CHANNEL_TERMINATOR = ":"
+
+# Messages are multipart: [channel, JSON message, *attachments]. Attachments
+# are raw binary frames, e.g. camera images or audio, and are handed to the
+# receive callbacks as memoryviews over the received frames without copying.
+Buffer = Union[bytes, bytearray, memoryview]
+ReceivedMessage = Tuple[str, List[memoryview]]
+ReceiveCallback = Callable[[str, List[memoryview]], None]
+AsyncReceiveCallback = Callable[[str, List[memoryview]], Awaitable[None]]
+
+# Each channel has its own bounded queue and worker. When the queue is full,
+# "drop_oldest" keeps the latest messages (e.g. camera frames) and
+# "drop_newest" discards incoming messages, counting them as dropped, so that a
+# slow callback only affects its own channel. "block" loses nothing, but stalls
+# the receive loop until there is room, which stops all channels of the socket,
+# so it is only meant for rare messages that must not be lost, e.g. gate
+# commands.
+OverflowPolicy = Literal["block", "drop_oldest", "drop_newest"]
+
+DEFAULT_MAX_QUEUE_SIZE = 64
+DEFAULT_OVERFLOW_POLICY: OverflowPolicy = "drop_oldest"
+
+# Subscribers publish the stats of their channel queues on
+# "stats/<name of the comm>" every this many seconds, so that the broker can
+# report the messages dropped by subscribers that do not keep up
+STATS_CHANNEL = "stats"
+DEFAULT_STATS_INTERVAL = 10.0
+
+T = TypeVar("T")
+
+
+class ChannelStats(TypedDict):
+    depth: int
+    max_queue_size: int
+    received: int
+    dropped: int
 
 
 class Comm(ABC):
@@ -15,32 +79,97 @@ def disconnect(self) -> None:
         raise NotImplementedError
 
     @abstractmethod
-    def send(self, channel: str, message: str) -> None:
+    def send(
+        self, channel: str, message: str, attachments: Sequence[Buffer] = ()
+    ) -> None:
         raise NotImplementedError
 
     @abstractmethod
-    def register_receive_callback(self, callback: Callable[[str], None]) -> None:
+    def register_receive_callback(
+        self,
+        channel: str,
+        callback: ReceiveCallback,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+    ) -> None:
         raise NotImplementedError
 
+    @abstractmethod
+    def get_channel_stats(self) -> Dict[str, ChannelStats]:
+        raise NotImplementedError
+
+
+class AsyncComm(ABC):
+    @abstractmethod
+    async def connect(self) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def disconnect(self) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def send(
+        self, channel: str, message: str, attachments: Sequence[Buffer] = ()
+    ) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def register_receive_callback(
+        self,
+        channel: str,
+        callback: AsyncReceiveCallback,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+    ) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def receive(
+        self,
+        channel: str,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+    ) -> AsyncIterator[ReceivedMessage]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_channel_stats(self) -> Dict[str, ChannelStats]:
+        raise NotImplementedError
+
+
+class AsyncZmqComm(AsyncComm):
+    # ZMQ sockets are not thread-safe, so an AsyncZmqComm must only be used
+    # from the event loop that runs it.
 
-class ZmqComm(Comm):
     def __init__(
-        self, broker_host: str, broker_backend_port: int, broker_frontend_port: int
+        self,
+        broker_host: str,
+        broker_backend_port: int,
+        broker_frontend_port: int,
+        name: Optional[str] = None,
+        stats_interval: float = DEFAULT_STATS_INTERVAL,
     ):
         self._broker_host = broker_host
         self._broker_backend_port = broker_backend_port
         self._broker_frontend_port = broker_frontend_port
 
-        self._publisher = zmq.Context().socket(zmq.PUB)
+        # Identifies the stats of this comm in the report of the broker
+        self._name = name if name is not None else socket.gethostname()
+        self._stats_interval = stats_interval
 
-        self._subscriber = zmq.Context().socket(zmq.SUB)
-        self._subscriber.setsockopt_string(zmq.SUBSCRIBE, "")
+        self._publisher = zmq.asyncio.Context.instance().socket(zmq.PUB)
 
-        self._loop_task_thread: Optional[threading.Thread] = None
-        self._loop_task_thread_should_run: bool = True
-        self._receive_callbacks: Dict[str, Callable[[str], None]] = {}
+        # Topics are only subscribed once a callback is registered, so that
+        # unwanted traffic is filtered by the broker instead of in Python.
+        self._subscriber = zmq.asyncio.Context.instance().socket(zmq.SUB)
 
-    def connect(self) -> None:
+        self._loop_task: Optional[asyncio.Task] = None
+        self._stats_task: Optional[asyncio.Task] = None
+        self._channel_queues: Dict[str, ChannelQueue] = {}
+        self._worker_tasks: Dict[str, asyncio.Task] = {}
+
+    async def connect(self) -> None:
         self._publisher.connect(
             f"tcp://{self._broker_host}:{self._broker_backend_port}"
         )
@@ -48,14 +177,16 @@ def connect(self) -> None:
             f"tcp://{self._broker_host}:{self._broker_frontend_port}"
         )
 
-        self._loop_task_thread_should_run = True
-        self._loop_task_thread = threading.Thread(target=self._loop_task_func)
-        self._loop_task_thread.start()
+        self._loop_task = asyncio.create_task(self._loop_task_func())
+        self._stats_task = asyncio.create_task(self._stats_task_func())
 
-    def disconnect(self) -> None:
-        assert self._loop_task_thread is not None
-        self._loop_task_thread_should_run = False
-        self._loop_task_thread.join()
+    async def disconnect(self) -> None:
+        assert self._loop_task is not None and self._stats_task is not None
+
+        tasks = [self._loop_task, self._stats_task, *self._worker_tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
         self._publisher.disconnect(
             f"tcp://{self._broker_host}:{self._broker_backend_port}"
@@ -64,19 +195,283 @@ def disconnect(self) -> None:
             f"tcp://{self._broker_host}:{self._broker_frontend_port}"
         )
 
-    def send(self, channel: str, message: str) -> None:
-        self._publisher.send_string(f"{channel}:{message}")
+    async def send(
+        self, channel: str, message: str, attachments: Sequence[Buffer] = ()
+    ) -> None:
+        await self._publisher.send_multipart(
+            [f"{channel}{CHANNEL_TERMINATOR}".encode(), message.encode(), *attachments],
+            copy=False,
+        )
 
     def register_receive_callback(
-        self, channel: str, callback: Callable[[str], None]
+        self,
+        channel: str,
+        callback: AsyncReceiveCallback,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
     ) -> None:
-        self._receive_callbacks[channel] = callback
+        channel_queue = self._add_channel_queue(
+            channel, max_queue_size, overflow_policy
+        )
+        self._worker_tasks[channel] = asyncio.create_task(
+            self._worker_task_func(channel_queue, callback)
+        )
+
+    def receive(
+        self,
+        channel: str,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+    ) -> AsyncIterator[ReceivedMessage]:
+        return self._add_channel_queue(channel, max_queue_size, overflow_policy)
+
+    def get_channel_stats(self) -> Dict[str, ChannelStats]:
+        return {
+            channel: channel_queue.get_stats()
+            for channel, channel_queue in self._channel_queues.items()
+        }
+
+    def _add_channel_queue(
+        self, channel: str, max_queue_size: int, overflow_policy: OverflowPolicy
+    ) -> "ChannelQueue":
+        old_worker_task = self._worker_tasks.pop(channel, None)
+        if old_worker_task is not None:
+            old_worker_task.cancel()
+
+        old_channel_queue = self._channel_queues.get(channel)
+        if old_channel_queue is not None:
+            old_channel_queue.close()
+
+        channel_queue = ChannelQueue(max_queue_size, overflow_policy)
+        self._channel_queues[channel] = channel_queue
+
+        for topic in get_channel_topics(channel):
+            self._subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+        return channel_queue
+
+    async def _loop_task_func(self) -> None:
+        while True:
+            frames: List[zmq.Frame] = await self._subscriber.recv_multipart(copy=False)
+
+            # A malformed message must not end the receive loop
+            try:
+                channel, message, attachments = parse_frames(frames)
+            except (IndexError, UnicodeDecodeError, ValueError):
+                traceback.print_exc()
+                continue
+
+            channel_queue = self._find_channel_queue(channel)
+            if channel_queue is not None:
+                await channel_queue.put(message, attachments)
+
+    async def _stats_task_func(self) -> None:
+        while True:
+            await asyncio.sleep(self._stats_interval)
+
+            # Only subscribers can drop messages
+            if len(self._channel_queues) == 0:
+                continue
+
+            comm_stats = {
+                "endpoint": self._name,
+                "messageId": "CommStats",
+                "channels": self.get_channel_stats(),
+            }
+            try:
+                await self.send(
+                    f"{STATS_CHANNEL}{CHANNEL_SEPARATOR}{self._name}",
+                    json.dumps(comm_stats),
+                )
+            except zmq.ZMQError:
+                traceback.print_exc()
+
+    async def _worker_task_func(
+        self, channel_queue: "ChannelQueue", callback: AsyncReceiveCallback
+    ) -> None:
+        async for message, attachments in channel_queue:
+            try:
+                await callback(message, attachments)
+            except Exception:
+                traceback.print_exc()
+
+    def _find_channel_queue(self, channel: str) -> Optional["ChannelQueue"]:
+        while True:
+            channel_queue = self._channel_queues.get(channel)
+            if channel_queue is not None:
+                return channel_queue
+
+            if CHANNEL_SEPARATOR not in channel:
+                return None
+
+            channel = channel.rsplit(CHANNEL_SEPARATOR, 1)[0]
+
+
+def get_channel_topics(channel: str) -> List[str]:
+    # ZMQ subscriptions are prefix matches, so the terminator and separator are
+    # included to avoid e.g. "sensor" also matching a "sensors" channel.
+    return [f"{channel}{CHANNEL_TERMINATOR}", f"{channel}{CHANNEL_SEPARATOR}"]
+
+
+def parse_frames(frames: List[zmq.Frame]) -> Tuple[str, str, List[memoryview]]:
+    if len(frames) == 1:
+        # Single-frame "channel:message" from a legacy publisher
+        channel, separator, message = (
+            frames[0].bytes.decode().partition(CHANNEL_TERMINATOR)
+        )
+        if separator == "":
+            raise ValueError("Single-frame message without a channel")
+
+        return channel, message, []
+
+    channel = frames[0].bytes.decode().removesuffix(CHANNEL_TERMINATOR)
+    message = frames[1].bytes.decode()
+    return channel, message, [frame.buffer for frame in frames[2:]]
+
+
+class ZmqComm(Comm):
+    # Blocking wrapper which runs an AsyncZmqComm on an event loop in a
+    # background thread. Callbacks run in worker threads, one message at a time
+    # per channel, so they may block without stalling other channels.
+
+    def __init__(
+        self,
+        broker_host: str,
+        broker_backend_port: int,
+        broker_frontend_port: int,
+        name: Optional[str] = None,
+        stats_interval: float = DEFAULT_STATS_INTERVAL,
+    ):
+        self._comm = AsyncZmqComm(
+            broker_host,
+            broker_backend_port,
+            broker_frontend_port,
+            name,
+            stats_interval,
+        )
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_task_thread: Optional[threading.Thread] = None
+        self._pending_registrations: List[
+            Tuple[str, ReceiveCallback, int, OverflowPolicy]
+        ] = []
+
+    def connect(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._loop_task_thread = threading.Thread(target=self._loop.run_forever)
+        self._loop_task_thread.start()
+
+        self._run(self._comm.connect())
+
+        for registration in self._pending_registrations:
+            self.register_receive_callback(*registration)
+        self._pending_registrations.clear()
+
+    def disconnect(self) -> None:
+        assert self._loop is not None and self._loop_task_thread is not None
+
+        self._run(self._comm.disconnect())
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_task_thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def send(
+        self, channel: str, message: str, attachments: Sequence[Buffer] = ()
+    ) -> None:
+        self._run(self._comm.send(channel, message, attachments))
+
+    def register_receive_callback(
+        self,
+        channel: str,
+        callback: ReceiveCallback,
+        max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+        overflow_policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+    ) -> None:
+        if self._loop is None:
+            self._pending_registrations.append(
+                (channel, callback, max_queue_size, overflow_policy)
+            )
+            return
+
+        async def async_callback(message: str, attachments: List[memoryview]) -> None:
+            await asyncio.to_thread(callback, message, attachments)
+
+        async def register() -> None:
+            self._comm.register_receive_callback(
+                channel, async_callback, max_queue_size, overflow_policy
+            )
+
+        self._run(register())
+
+    def get_channel_stats(self) -> Dict[str, ChannelStats]:
+        return self._comm.get_channel_stats()
+
+    def _run(self, coroutine: Coroutine[None, None, T]) -> T:
+        assert self._loop is not None
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+
+class ChannelQueue:
+    def __init__(self, max_queue_size: int, overflow_policy: OverflowPolicy):
+        assert max_queue_size > 0
+
+        self._max_queue_size = max_queue_size
+        self._overflow_policy = overflow_policy
+
+        self._queue: Deque[ReceivedMessage] = collections.deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._closed: bool = False
+        self._received: int = 0
+        self._dropped: int = 0
+
+    def __aiter__(self) -> "ChannelQueue":
+        return self
+
+    async def __anext__(self) -> ReceivedMessage:
+        while len(self._queue) == 0:
+            if self._closed:
+                raise StopAsyncIteration
+
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        item = self._queue.popleft()
+        self._not_full.set()
+        return item
+
+    async def put(self, message: str, attachments: List[memoryview]) -> None:
+        self._received += 1
+
+        while len(self._queue) >= self._max_queue_size and not self._closed:
+            match self._overflow_policy:
+                case "block":
+                    self._not_full.clear()
+                    await self._not_full.wait()
+
+                case "drop_oldest":
+                    self._queue.popleft()
+                    self._dropped += 1
+
+                case "drop_newest":
+                    self._dropped += 1
+                    return
+
+        self._queue.append((message, attachments))
+        self._not_empty.set()
 
-    def _loop_task_func(self) -> None:
-        while self._loop_task_thread_should_run:
-            message = self._subscriber.recv_string()
-            channel, message = message.split(":", 1)
+    def close(self) -> None:
+        self._closed = True
+        self._not_empty.set()
+        self._not_full.set()
 
-            for callback_channel, callback in self._receive_callbacks.items():
-                if channel == callback_channel:
-                    callback(message)
+    def get_stats(self) -> ChannelStats:
+        return {
+            "depth": len(self._queue),
+            "max_queue_size": self._max_queue_size,
+            "received": self._received,
+            "dropped": self._dropped,
+        }
@@ -1,4 +1,5 @@
 import json
+from typing import List
 
 from comm import ZmqComm
 from schemas import ActuatorRegistration
@@ -13,6 +14,7 @@
     broker_host=COMM_BROKER_HOST,
     broker_backend_port=COMM_BROKER_BACKEND_PORT,
     broker_frontend_port=COMM_BROKER_FRONTEND_PORT,
+    name="actuator_client",
 )
 
 
@@ -20,7 +22,10 @@ def main() -> None:
     comm.connect()
     bt_serial = bt_serial_connect(1)
     actuator_regist(bt_serial)
-    comm.register_receive_callback("actuator", actuator_comm_callback)
+    # Gate commands must not be lost, and are too rare to stall the socket
+    comm.register_receive_callback(
+        "actuator/gate", actuator_comm_callback, overflow_policy="block"
+    )
 
 def actuator_regist(bt_serial) -> None:    
     time.sleep(0.1)
@@ -37,7 +42,7 @@ def actuator_regist(bt_serial) -> None:
                 actuatorDescription="Gate actuator to open and close the gate.",
                 commandFormatDescription=cmd_format,
             )
-            comm.send("actuator", str(actuator_registration))
+            comm.send("actuator/registration", json.dumps(actuator_registration))
         if 'light' in cmd_format:
             actuator_registration = ActuatorRegistration(
                 endpoint="light",
@@ -46,7 +51,7 @@ def actuator_regist(bt_serial) -> None:
                 actuatorDescription="Light actuator to control the light.",
                 commandFormatDescription=cmd_format,
             )
-            comm.send("actuator", str(actuator_registration))
+            comm.send("actuator/registration", json.dumps(actuator_registration))
         if 'aircon' in cmd_format:
             actuator_registration = ActuatorRegistration(
                 endpoint="aircon",
@@ -55,9 +60,9 @@ def actuator_regist(bt_serial) -> None:
                 actuatorDescription="Airconditioner actuator to control the airconditioner.",
                 commandFormatDescription=cmd_format,
             )
-            comm.send("actuator", str(actuator_registration))
+            comm.send("actuator/registration", json.dumps(actuator_registration))
 
-def actuator_comm_callback(msg_str: str) -> None:
+def actuator_comm_callback(msg_str: str, attachments: List[memoryview]) -> None:
     msg = json.loads(msg_str)
     if msg["messageId"] != "ActuatorCommand":
         return
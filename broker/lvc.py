@@ -0,0 +1,51 @@
+import json
+from typing import Dict, List, Set, Tuple
+
+import zmq
+
+
+class LastValueCache:
+    def __init__(self, channels: Set[str], message_ids: Set[str]):
+        # Only state-like messages may be cached. Replaying e.g. an
+        # ActuatorCommand to a late joiner would repeat the command, and an
+        # old camera frame would be analyzed as if it had just been taken.
+        self._channels = channels
+        self._message_ids = message_ids
+        self._message_id_markers = [message_id.encode() for message_id in message_ids]
+
+        self._entries: Dict[Tuple[str, str], List[zmq.Frame]] = {}
+
+    def update(self, channel: str, frames: List[zmq.Frame]) -> None:
+        if channel not in self._channels:
+            return
+
+        if len(frames) == 1:
+            # Single-frame "channel:message" from a legacy publisher
+            _, _, header = frames[0].bytes.partition(b":")
+        else:
+            header = frames[1].bytes
+
+        # Cheap check to avoid parsing the JSON of messages that are not cached
+        if not any(marker in header for marker in self._message_id_markers):
+            return
+
+        try:
+            msg = json.loads(header)
+            message_id = msg["messageId"]
+            endpoint = msg["endpoint"]
+        except (ValueError, KeyError, TypeError):
+            return
+
+        if message_id not in self._message_ids:
+            return
+
+        # Frames stay valid after being sent, so they can be replayed as is
+        self._entries[(channel, str(endpoint))] = frames
+
+    def get_snapshot(self, topic: bytes) -> List[List[zmq.Frame]]:
+        # Matched like ZMQ subscriptions, on the prefix of the first frame
+        return [
+            frames
+            for frames in self._entries.values()
+            if frames[0].bytes.startswith(topic)
+        ]
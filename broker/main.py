@@ -0,0 +1,197 @@
+import json
+import time
+import traceback
+from typing import List, Optional
+
+import zmq
+from lvc import LastValueCache
+from stats import BrokerStats
+
+# Subscribers connect to the frontend, publishers to the backend
+BROKER_FRONTEND_PORT = 5555
+BROKER_BACKEND_PORT = 5556
+
+# Every forwarded message is mirrored to this address if set, e.g.
+# "tcp://*:5557", so the traffic can be recorded or inspected.
+BROKER_CAPTURE_ADDRESS: Optional[str] = None
+
+STATS_INTERVAL = 10  # seconds
+
+# The latest message of these types on these channels is kept per channel and
+# endpoint, and sent to new subscribers so that e.g. a restarted server
+# immediately learns the registered actuators and the environment, and a sound
+# client the manifest of the question sounds. Other subscribers of the topic
+# receive the snapshot again, so these messages must be idempotent. Channels of
+# events, e.g. camera frames and answers to questions, must not be cached.
+LVC_CHANNELS = {"actuator/registration", "actuator/question", "sensor/Environment"}
+LVC_MESSAGE_IDS = {"ActuatorRegistration", "QuestionManifest", "SensorReport"}
+
+# Messages queued per subscriber before further ones are dropped for it
+SUBSCRIBER_HWM = 1000
+
+# Subscribers publish the stats of their channel queues on sub-topics of this
+# channel, including the messages they dropped
+STATS_CHANNEL = "stats"
+
+
+def main() -> None:
+    context = zmq.Context.instance()
+
+    frontend = context.socket(zmq.XPUB)
+    # Pass on every (un)subscription rather than only the first and last one
+    # per topic, so that subscribers can be counted.
+    frontend.setsockopt(zmq.XPUB_VERBOSER, 1)
+    # Messages for a subscriber that does not keep up are dropped for that
+    # subscriber only. The broker cannot see these drops, so subscribers
+    # publish the drops of their channel queues, which the broker reports.
+    frontend.setsockopt(zmq.SNDHWM, SUBSCRIBER_HWM)
+    frontend.bind(f"tcp://*:{BROKER_FRONTEND_PORT}")
+
+    backend = context.socket(zmq.XSUB)
+    backend.bind(f"tcp://*:{BROKER_BACKEND_PORT}")
+    # Receive everything from the publishers, even without subscribers, so
+    # that the last value cache is complete. Subscriptions are still applied
+    # by the frontend and are not forwarded.
+    backend.send(b"\x01")
+
+    capture: Optional[zmq.Socket] = None
+    if BROKER_CAPTURE_ADDRESS is not None:
+        capture = context.socket(zmq.PUB)
+        capture.bind(BROKER_CAPTURE_ADDRESS)
+
+    print(
+        f"Broker listening, frontend port {BROKER_FRONTEND_PORT}, "
+        f"backend port {BROKER_BACKEND_PORT}"
+    )
+
+    run_proxy(
+        frontend,
+        backend,
+        capture,
+        BrokerStats(),
+        LastValueCache(LVC_CHANNELS, LVC_MESSAGE_IDS),
+    )
+
+
+def run_proxy(
+    frontend: zmq.Socket,
+    backend: zmq.Socket,
+    capture: Optional[zmq.Socket],
+    stats: BrokerStats,
+    lvc: LastValueCache,
+) -> None:
+    # Like zmq.proxy(frontend, backend, capture), but forwarding messages by
+    # hand lets the broker account for every message, and answer new
+    # subscriptions from the last value cache.
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+
+    next_report_time = time.monotonic() + STATS_INTERVAL
+
+    while True:
+        timeout_ms = max(next_report_time - time.monotonic(), 0) * 1000
+        events = dict(poller.poll(timeout_ms))
+
+        # A malformed message must not stop the broker
+        if frontend in events:
+            frames: List[zmq.Frame] = frontend.recv_multipart(copy=False)
+            try:
+                handle_subscription(frames, frontend, stats, lvc)
+            except Exception:
+                traceback.print_exc()
+
+        if backend in events:
+            received_time = time.perf_counter()
+            frames = backend.recv_multipart(copy=False)
+            try:
+                forward_message(frames, frontend, capture, stats, lvc, received_time)
+            except Exception:
+                traceback.print_exc()
+
+        if time.monotonic() >= next_report_time:
+            print_stats(stats)
+            next_report_time = time.monotonic() + STATS_INTERVAL
+
+
+def handle_subscription(
+    frames: List[zmq.Frame],
+    frontend: zmq.Socket,
+    stats: BrokerStats,
+    lvc: LastValueCache,
+) -> None:
+    # Subscription messages are a single frame of b"\x01" or b"\x00" (for
+    # subscribe and unsubscribe) followed by the topic.
+    subscription = frames[0].bytes
+    if len(frames) != 1 or len(subscription) == 0 or subscription[0] not in (0, 1):
+        return
+
+    topic = subscription[1:]
+    subscribed = subscription[0] == 1
+    stats.record_subscription(topic.decode(errors="replace"), subscribed)
+
+    if not subscribed:
+        return
+
+    for snapshot_frames in lvc.get_snapshot(topic):
+        frontend.send_multipart(snapshot_frames, copy=False)
+
+
+def forward_message(
+    frames: List[zmq.Frame],
+    frontend: zmq.Socket,
+    capture: Optional[zmq.Socket],
+    stats: BrokerStats,
+    lvc: LastValueCache,
+    received_time: float,
+) -> None:
+    channel = get_channel(frames)
+    lvc.update(channel, frames)
+
+    if channel.startswith(f"{STATS_CHANNEL}/"):
+        record_subscriber_stats(frames, stats)
+
+    frontend.send_multipart(frames, copy=False)
+
+    if capture is not None:
+        capture.send_multipart(frames, copy=False)
+
+    stats.record_message(
+        channel,
+        sum(len(frame) for frame in frames),
+        time.perf_counter() - received_time,
+    )
+
+
+def record_subscriber_stats(frames: List[zmq.Frame], stats: BrokerStats) -> None:
+    # A malformed report is skipped, but the message is still forwarded
+    try:
+        comm_stats = json.loads(frames[1].bytes)
+        stats.record_subscriber_stats(comm_stats["endpoint"], comm_stats["channels"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        traceback.print_exc()
+
+
+def get_channel(frames: List[zmq.Frame]) -> str:
+    # The channel frame ends with a colon, like the channel of a single-frame
+    # "channel:message" from a legacy publisher
+    channel = frames[0].bytes.split(b":", 1)[0]
+
+    return channel.decode(errors="replace")
+
+
+def print_stats(stats: BrokerStats) -> None:
+    print(
+        json.dumps(
+            {
+                "channels": stats.take_reports(),
+                "subscribers": stats.get_subscriber_counts(),
+                "subscriber_drops": stats.get_subscriber_drops(),
+            },
+            ensure_ascii=False,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
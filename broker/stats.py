@@ -0,0 +1,95 @@
+import time
+from typing import Any, Dict, List, TypedDict
+
+
+class ChannelStats(TypedDict):
+    messages: int
+    bytes: int
+    latency_sum: float
+    latency_max: float
+
+
+class ChannelReport(TypedDict):
+    channel: str
+    messages_per_second: float
+    bytes_per_second: float
+    latency_mean_us: float
+    latency_max_us: float
+
+
+class BrokerStats:
+    def __init__(self):
+        self._channel_stats: Dict[str, ChannelStats] = {}
+        self._subscriber_counts: Dict[str, int] = {}
+        # Messages dropped so far per subscriber and channel, as last reported
+        # by the subscribers
+        self._subscriber_drops: Dict[str, Dict[str, int]] = {}
+        self._interval_start = time.monotonic()
+
+    def record_message(self, channel: str, size: int, latency: float) -> None:
+        stats = self._get_channel_stats(channel)
+        stats["messages"] += 1
+        stats["bytes"] += size
+        stats["latency_sum"] += latency
+        stats["latency_max"] = max(stats["latency_max"], latency)
+
+    def record_subscription(self, topic: str, subscribed: bool) -> None:
+        count = self._subscriber_counts.get(topic, 0) + (1 if subscribed else -1)
+        if count > 0:
+            self._subscriber_counts[topic] = count
+        else:
+            self._subscriber_counts.pop(topic, None)
+
+    def get_subscriber_counts(self) -> Dict[str, int]:
+        return dict(self._subscriber_counts)
+
+    def record_subscriber_stats(
+        self, subscriber: str, channel_stats: Dict[str, Any]
+    ) -> None:
+        self._subscriber_drops[subscriber] = {
+            channel: int(stats["dropped"]) for channel, stats in channel_stats.items()
+        }
+
+    def get_subscriber_drops(self) -> Dict[str, Dict[str, int]]:
+        return {
+            subscriber: dict(drops)
+            for subscriber, drops in self._subscriber_drops.items()
+        }
+
+    def take_reports(self) -> List[ChannelReport]:
+        # Rates are computed over the interval since the previous call
+        now = time.monotonic()
+        elapsed = max(now - self._interval_start, 1e-9)
+        self._interval_start = now
+
+        reports: List[ChannelReport] = []
+        for channel, stats in sorted(self._channel_stats.items()):
+            reports.append(
+                {
+                    "channel": channel,
+                    "messages_per_second": round(stats["messages"] / elapsed, 2),
+                    "bytes_per_second": round(stats["bytes"] / elapsed, 2),
+                    "latency_mean_us": (
+                        round(stats["latency_sum"] / stats["messages"] * 1e6, 1)
+                        if stats["messages"] > 0
+                        else 0.0
+                    ),
+                    "latency_max_us": round(stats["latency_max"] * 1e6, 1),
+                }
+            )
+
+        self._channel_stats.clear()
+        return reports
+
+    def _get_channel_stats(self, channel: str) -> ChannelStats:
+        stats = self._channel_stats.get(channel)
+        if stats is None:
+            stats = {
+                "messages": 0,
+                "bytes": 0,
+                "latency_sum": 0.0,
+                "latency_max": 0.0,
+            }
+            self._channel_stats[channel] = stats
+
+        return stats
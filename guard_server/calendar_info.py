@@ -0,0 +1,55 @@
+import datetime
+from typing import Dict, Literal
+
+import holidays
+
+# The smallest change of the current time that counts as a change of the
+# calendar endpoint, e.g. to trigger a new decision
+ChangeGranularity = Literal["hour", "day"]
+
+
+class CalendarInfo:
+    def __init__(self, country: str = "CN", granularity: ChangeGranularity = "hour"):
+        self._country = country
+        self._granularity: ChangeGranularity = granularity
+
+        # Building the holiday table is expensive, so it is done once per year
+        self._holiday_tables: Dict[int, Dict[datetime.date, str]] = {}
+
+    def get_data(self) -> Dict[str, str]:
+        now = datetime.datetime.now()
+
+        return {
+            "date_time": now.strftime("%Y-%m-%d %I%p %A"),
+            "holiday": self._get_holiday_table(now.year).get(now.date()) or "无节日",
+        }
+
+    def get_seconds_until_next_change(self) -> float:
+        now = datetime.datetime.now()
+
+        match self._granularity:
+            case "hour":
+                start = now.replace(minute=0, second=0, microsecond=0)
+                next_change = start + datetime.timedelta(hours=1)
+
+            case "day":
+                start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+                next_change = start + datetime.timedelta(days=1)
+
+        return (next_change - now).total_seconds()
+
+    def _get_holiday_table(self, year: int) -> Dict[datetime.date, str]:
+        holiday_table = self._holiday_tables.get(year)
+        if holiday_table is None:
+            holiday_table = dict(holidays.country_holidays(self._country, years=year))
+
+            # Only the current year is needed, and at most the previous one
+            # around the new year
+            self._holiday_tables = {
+                cached_year: table
+                for cached_year, table in self._holiday_tables.items()
+                if cached_year >= year - 1
+            }
+            self._holiday_tables[year] = holiday_table
+
+        return holiday_table
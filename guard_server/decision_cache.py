@@ -0,0 +1,143 @@
+import collections
+import hashlib
+import json
+import math
+import time
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Optional,
+    OrderedDict,
+    Tuple,
+    TypeVar,
+    TypedDict,
+)
+
+from info_db import InfoDbEntry
+
+T = TypeVar("T")
+
+# Fields that change with every report without changing the situation
+DEFAULT_VOLATILE_FIELDS: List[str] = ["Timestamp"]
+
+# Numeric fields are compared in buckets of these sizes, so that e.g. a change
+# of the temperature by 0.1 degrees does not need a new decision. Other fields
+# are compared exactly.
+DEFAULT_BUCKET_SIZES: Dict[str, float] = {
+    "Temperature": 1.0,
+    "Humidity": 5.0,
+    "LightStrength": 50.0,
+    # Changes slightly with every report. This is 1 hPa for readings in Pa,
+    # and readings in hPa merely end up in coarser buckets.
+    "Pressure": 100.0,
+}
+
+
+class DecisionCacheStats(TypedDict):
+    hits: int
+    misses: int
+    size: int
+
+
+class DecisionCache(Generic[T]):
+    def __init__(
+        self,
+        max_size: int = 256,
+        ttl: float = 600.0,
+        volatile_fields: Iterable[str] = DEFAULT_VOLATILE_FIELDS,
+        bucket_sizes: Dict[str, float] = DEFAULT_BUCKET_SIZES,
+        uncached_endpoints: Iterable[str] = (),
+    ):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._volatile_fields = set(volatile_fields)
+        self._bucket_sizes = dict(bucket_sizes)
+
+        # Decisions are not cached while any of these endpoints is present
+        self._uncached_endpoints = set(uncached_endpoints)
+
+        # Ordered from least to most recently used
+        self._entries: OrderedDict[str, Tuple[float, T]] = collections.OrderedDict()
+
+        self._hits: int = 0
+        self._misses: int = 0
+
+    def make_key(self, info: List[InfoDbEntry], context: Any = None) -> Optional[str]:
+        # The context is anything besides the info that the decision depends
+        # on, e.g. the registered actuators. Returns None if the decision must
+        # not be cached.
+        if any(entry["endpoint"] in self._uncached_endpoints for entry in info):
+            return None
+
+        normalized_info = {
+            entry["endpoint"]: self.normalize_entry(entry) for entry in info
+        }
+        content = json.dumps(
+            [normalized_info, context], sort_keys=True, ensure_ascii=False, default=str
+        )
+
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    def normalize_entry(self, entry: InfoDbEntry) -> Any:
+        # The data of the entry as far as decisions depend on it
+        return self._normalize(entry["data"], None)
+
+    def get(self, key: Optional[str]) -> Optional[T]:
+        if key is None:
+            return None
+
+        cached = self._entries.get(key)
+        if cached is None or time.monotonic() - cached[0] > self._ttl:
+            self._entries.pop(key, None)
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return cached[1]
+
+    def put(self, key: Optional[str], decision: T) -> None:
+        if key is None:
+            return
+
+        self._entries[key] = (time.monotonic(), decision)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def get_stats(self) -> DecisionCacheStats:
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "size": len(self._entries),
+        }
+
+    def _normalize(self, value: Any, field: Optional[str]) -> Any:
+        # Sensor clients report their data as a JSON string
+        if isinstance(value, str) and value.startswith(("{", "[")):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+
+        if isinstance(value, dict):
+            return {
+                key: self._normalize(item, key)
+                for key, item in value.items()
+                if key not in self._volatile_fields
+            }
+
+        if isinstance(value, list):
+            return [self._normalize(item, field) for item in value]
+
+        if field in self._bucket_sizes:
+            try:
+                return math.floor(float(value) / self._bucket_sizes[field])
+            except (TypeError, ValueError, OverflowError):
+                pass
+
+        return value
@@ -0,0 +1,147 @@
+import abc
+import io
+import os
+from typing import Dict, List, Optional, TypedDict
+
+import numpy as np
+import PIL.Image
+
+
+class FaceMatch(TypedDict):
+    resident: str
+    # Cosine similarity of the embeddings, from -1 to 1
+    score: float
+    reference_image: bytes
+
+
+class FaceEmbedder(abc.ABC):
+    # Whether scores tell the faces of different people apart, rather than
+    # mostly reflecting the rest of the image
+    discriminative: bool = True
+
+    @abc.abstractmethod
+    def embed(self, img: bytes) -> Optional[np.ndarray]:
+        # Returns a 1-D embedding of the face in the image, or None if there
+        # is none. Embeddings are compared by cosine similarity.
+        raise NotImplementedError
+
+
+class ThumbnailEmbedder(FaceEmbedder):
+    # Deterministic local stand-in that embeds the whole image as a small
+    # grayscale thumbnail. It needs no model, which makes it suitable for
+    # tests, but its scores are dominated by the background, so they can only
+    # rank residents and a match always needs to be verified.
+    discriminative = False
+
+    def __init__(self, size: int = 16):
+        self._size = size
+
+    def embed(self, img: bytes) -> Optional[np.ndarray]:
+        try:
+            with PIL.Image.open(io.BytesIO(img)) as image:
+                image.draft("L", (self._size * 8, self._size * 8))
+                thumbnail = image.convert("L").resize(
+                    (self._size, self._size), PIL.Image.Resampling.BILINEAR
+                )
+
+        except (OSError, ValueError):
+            return None
+
+        embedding = np.asarray(thumbnail, dtype=np.float32).flatten()
+        embedding -= embedding.mean()
+
+        # A uniform image has no features to compare
+        if not np.any(embedding):
+            return None
+
+        return embedding
+
+
+class FaceIndex:
+    def __init__(self, embedder: FaceEmbedder):
+        self._embedder = embedder
+
+        # One row of normalized embedding per reference image, so that a query
+        # is scored against all of them with a single matrix product
+        self._embeddings = np.empty((0, 0), dtype=np.float32)
+        self._residents: List[str] = []
+        self._reference_images: List[bytes] = []
+
+    def build(self, references: Dict[str, List[bytes]]) -> None:
+        embeddings: List[np.ndarray] = []
+        self._residents = []
+        self._reference_images = []
+
+        for resident, images in references.items():
+            for img in images:
+                embedding = self._embedder.embed(img)
+                if embedding is None:
+                    print(f"No face found in a reference image of {resident}")
+                    continue
+
+                embeddings.append(embedding / np.linalg.norm(embedding))
+                self._residents.append(resident)
+                self._reference_images.append(img)
+
+        self._embeddings = (
+            np.stack(embeddings).astype(np.float32)
+            if len(embeddings) > 0
+            else np.empty((0, 0), dtype=np.float32)
+        )
+
+    def is_discriminative(self) -> bool:
+        return self._embedder.discriminative
+
+    def search(self, img: bytes, top_k: Optional[int] = 1) -> Optional[List[FaceMatch]]:
+        # Returns the best matching reference images, best first, at most one
+        # per resident, or for every resident if top_k is None. Returns None
+        # if there is no face in the image.
+        embedding = self._embedder.embed(img)
+        if embedding is None:
+            return None
+
+        if len(self._residents) == 0:
+            return []
+
+        scores = self._embeddings @ (embedding / np.linalg.norm(embedding))
+
+        matches: List[FaceMatch] = []
+        for i in np.argsort(-scores):
+            if top_k is not None and len(matches) >= top_k:
+                break
+
+            if any(match["resident"] == self._residents[i] for match in matches):
+                continue
+
+            matches.append(
+                {
+                    "resident": self._residents[i],
+                    "score": float(scores[i]),
+                    "reference_image": self._reference_images[i],
+                }
+            )
+
+        return matches
+
+
+def load_references(directory: str) -> Dict[str, List[bytes]]:
+    # Reference images are stored as <directory>/<resident>/<image>
+    references: Dict[str, List[bytes]] = {}
+    if not os.path.isdir(directory):
+        return references
+
+    for resident_entry in os.scandir(directory):
+        if not resident_entry.is_dir():
+            continue
+
+        images: List[bytes] = []
+        for image_entry in sorted(
+            os.scandir(resident_entry.path), key=lambda e: e.name
+        ):
+            if image_entry.is_file():
+                with open(image_entry.path, "rb") as f:
+                    images.append(f.read())
+
+        references[resident_entry.name] = images
+
+    return references
@@ -0,0 +1,41 @@
+import io
+import os
+
+import alibabacloud_facebody20191230.client
+import alibabacloud_facebody20191230.models
+import alibabacloud_tea_openapi.models
+import alibabacloud_tea_util.models
+
+
+class CloudFaceVerifier:
+    def __init__(self):
+        config = alibabacloud_tea_openapi.models.Config(
+            access_key_id=os.environ.get("ALIBABA_CLOUD_ACCESS_KEY_ID") or "",
+            access_key_secret=os.environ.get("ALIBABA_CLOUD_ACCESS_KEY_SECRET") or "",
+            endpoint="facebody.cn-shanghai.aliyuncs.com",
+            region_id="cn-shanghai",
+        )
+
+        # Created once and reused for every comparison
+        self._client = alibabacloud_facebody20191230.client.Client(config)
+        self._runtime_options = alibabacloud_tea_util.models.RuntimeOptions()
+
+    def compare(self, img: bytes, reference_img: bytes) -> float:
+        # Returns the confidence from 0 to 100 that both images show the same
+        # person
+        compare_face_request = (
+            alibabacloud_facebody20191230.models.CompareFaceAdvanceRequest(
+                image_urlaobject=io.BytesIO(img),
+                image_urlbobject=io.BytesIO(reference_img),
+            )
+        )
+
+        response = self._client.compare_face_advance(
+            compare_face_request, self._runtime_options
+        )
+        confidence = response.body.data.confidence
+        assert isinstance(confidence, float)
+
+        print(response.body.data)
+
+        return confidence
@@ -0,0 +1,268 @@
+import asyncio
+import io
+import time
+import traceback
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+)
+
+import numpy as np
+import PIL.Image
+from frame_store import Frame, FrameStore
+from info_db import InfoDb, InfoDbEntry
+from motion_gate import MotionGate, MotionGateStats, compute_image_thumbnail
+from perceptual_hash import compute_image_dhash
+
+# Analyzes a frame and returns the data of the endpoint of the stage
+FrameAnalyzer = Callable[[Frame], Awaitable[Any]]
+
+
+class FrameAnalysis(TypedDict):
+    sequence: int
+    # Version of the InfoDb in which the results of all stages were inserted
+    version: int
+    analyzed_time: float
+
+
+class FramePipelineStats(TypedDict):
+    analyzed: int
+    failed_stages: Dict[str, int]
+    throttled_stages: Dict[str, int]
+    motion_gate: Optional[MotionGateStats]
+
+
+class FramePipelineStage(TypedDict):
+    endpoint: str
+    description: str
+    analyze: FrameAnalyzer
+    # Data of the endpoint if the analysis fails or there is no frame yet
+    fallback: Any
+    # Minimum seconds between two analyses by the stage, in between which its
+    # last result is kept along with the sequence of its frame
+    min_interval: float
+
+
+class FramePipeline:
+    # Runs all stages on the same frame concurrently, and inserts their results
+    # into the InfoDb together, each with the sequence number of the frame it
+    # stems from. A decision thus never sees the results of a half-analyzed
+    # frame, and can tell when a throttled stage kept a result of an older one.
+    def __init__(
+        self,
+        frame_store: FrameStore,
+        info_db: InfoDb,
+        min_interval: float = 1.0,
+        motion_gate: Optional[MotionGate] = None,
+        is_person_present: Optional[Callable[[], bool]] = None,
+    ):
+        self._frame_store = frame_store
+        self._info_db = info_db
+        self._min_interval = min_interval
+        self._motion_gate = motion_gate
+        self._is_person_present = is_person_present
+
+        self._stages: List[FramePipelineStage] = []
+
+        self._latest_analysis: Optional[FrameAnalysis] = None
+
+        # Time, frame sequence and result of the last analysis per stage
+        self._last_results: Dict[str, Tuple[float, int, Any]] = {}
+
+        self._analyzed: int = 0
+        self._failed_stages: Dict[str, int] = {}
+        self._throttled_stages: Dict[str, int] = {}
+
+    def add_stage(
+        self,
+        endpoint: str,
+        description: str,
+        analyze: FrameAnalyzer,
+        fallback: Any = "缺失",
+        min_interval: float = 0.0,
+    ) -> None:
+        self._stages.append(
+            {
+                "endpoint": endpoint,
+                "description": description,
+                "analyze": analyze,
+                "fallback": fallback,
+                "min_interval": min_interval,
+            }
+        )
+
+    async def run(self) -> None:
+        # Results restored from before a restart refer to frames that are gone
+        self._info_db.insert_many(
+            [self._make_entry(stage, stage["fallback"], None) for stage in self._stages]
+        )
+
+        frame_sequence: int = 0
+
+        while True:
+            frame = await self._frame_store.async_wait_for_frame(frame_sequence)
+            assert frame is not None
+            frame_sequence = frame["sequence"]
+
+            if self._motion_gate is not None and not self._motion_gate.should_pass(
+                frame["thumbnail"],
+                self._is_person_present is not None and self._is_person_present(),
+            ):
+                continue
+
+            results = await asyncio.gather(
+                *(self._analyze(stage, frame) for stage in self._stages)
+            )
+
+            self._info_db.insert_many(
+                [
+                    self._make_entry(stage, data, sequence)
+                    for stage, (sequence, data) in zip(self._stages, results)
+                ]
+            )
+            self._latest_analysis = {
+                "sequence": frame_sequence,
+                "version": self._info_db.get_version(),
+                "analyzed_time": time.time(),
+            }
+            self._analyzed += 1
+
+            # Bounds the rate of requests while frames keep arriving
+            await asyncio.sleep(self._min_interval)
+
+    def get_latest_analysis(self) -> Optional[FrameAnalysis]:
+        return self._latest_analysis
+
+    def get_stats(self) -> FramePipelineStats:
+        return {
+            "analyzed": self._analyzed,
+            "failed_stages": dict(self._failed_stages),
+            "throttled_stages": dict(self._throttled_stages),
+            "motion_gate": (
+                self._motion_gate.get_stats() if self._motion_gate is not None else None
+            ),
+        }
+
+    async def _analyze(
+        self, stage: FramePipelineStage, frame: Frame
+    ) -> Tuple[int, Any]:
+        # Returns the sequence of the frame the result stems from and the result
+        endpoint = stage["endpoint"]
+
+        last_result = self._last_results.get(endpoint)
+        if (
+            last_result is not None
+            and time.monotonic() - last_result[0] < stage["min_interval"]
+        ):
+            self._throttled_stages[endpoint] = (
+                self._throttled_stages.get(endpoint, 0) + 1
+            )
+            return last_result[1], last_result[2]
+
+        try:
+            result = await stage["analyze"](frame)
+
+        except Exception:
+            traceback.print_exc()
+
+            self._failed_stages[endpoint] = self._failed_stages.get(endpoint, 0) + 1
+            result = stage["fallback"]
+
+        self._last_results[endpoint] = (time.monotonic(), frame["sequence"], result)
+
+        return frame["sequence"], result
+
+    def _make_entry(
+        self, stage: FramePipelineStage, data: Any, sequence: Optional[int]
+    ) -> InfoDbEntry:
+        entry: InfoDbEntry = {
+            "endpoint": stage["endpoint"],
+            "description": stage["description"],
+            "data": data,
+        }
+        if sequence is not None:
+            entry["sequence"] = sequence
+
+        return entry
+
+
+def select_informative_frames(
+    latest: Frame,
+    frames: Sequence[Frame],
+    count: int,
+    window: float,
+    min_changed_fraction: float = 0.02,
+    pixel_threshold: int = 25,
+) -> List[Frame]:
+    # Picks up to count frames from those received at most window seconds
+    # before latest, including latest, which differ from each other the most,
+    # in chronological order. Frames that differ from all picked ones in less
+    # than min_changed_fraction of their pixels add nothing and are left out.
+    if latest["thumbnail"] is None:
+        return [latest]
+
+    candidates = [
+        frame
+        for frame in frames
+        if frame["sequence"] < latest["sequence"]
+        and latest["received_time"] - frame["received_time"] <= window
+        and frame["thumbnail"] is not None
+        and frame["thumbnail"].shape == latest["thumbnail"].shape
+    ]
+    if count <= 1 or len(candidates) == 0:
+        return [latest]
+
+    thumbnails = np.stack([frame["thumbnail"] for frame in candidates])
+
+    # Fraction of changed pixels of each candidate against the closest picked
+    # frame, and the candidate that differs the most is picked next
+    differences = get_changed_fractions(
+        thumbnails, latest["thumbnail"], pixel_threshold
+    )
+    selected = [latest]
+    while len(selected) < count:
+        index = int(np.argmax(differences))
+        if differences[index] < min_changed_fraction:
+            break
+
+        selected.append(candidates[index])
+        differences = np.minimum(
+            differences,
+            get_changed_fractions(thumbnails, thumbnails[index], pixel_threshold),
+        )
+
+    return sorted(selected, key=lambda frame: frame["sequence"])
+
+
+def get_changed_fractions(
+    thumbnails: np.ndarray, reference: np.ndarray, pixel_threshold: int
+) -> np.ndarray:
+    changed = np.abs(thumbnails - reference) > pixel_threshold
+    return changed.mean(axis=(1, 2))
+
+
+def decode_frame(
+    img: bytes, hash_size: int = 8, thumbnail_size: int = 64
+) -> Tuple[Optional[int], Optional[np.ndarray]]:
+    # Decodes the image once for both the perceptual hash and the thumbnail of
+    # the motion gate. Returns None for both if the image cannot be decoded.
+    try:
+        with PIL.Image.open(io.BytesIO(img)) as image:
+            draft_size = max(hash_size * 8, thumbnail_size * 2)
+            image.draft("L", (draft_size, draft_size))
+            grayscale = image.convert("L")
+
+            return (
+                compute_image_dhash(grayscale, hash_size),
+                compute_image_thumbnail(grayscale, thumbnail_size),
+            )
+
+    except (OSError, ValueError):
+        return None, None
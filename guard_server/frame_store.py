@@ -0,0 +1,102 @@
+import asyncio
+import collections
+import hashlib
+import threading
+import time
+from typing import Deque, List, Optional, Tuple, TypedDict
+
+import numpy as np
+from info_db import wake_async_waiters
+
+
+class Frame(TypedDict):
+    # Increases by one with every new frame, starting at 1
+    sequence: int
+    data: bytes
+    sha256: str
+    # Perceptual hash and grayscale thumbnail, if computed by the producer
+    dhash: Optional[int]
+    thumbnail: Optional[np.ndarray]
+    received_time: float
+
+
+class FrameStore:
+    def __init__(self, capacity: int = 8):
+        # Only the latest frames are kept, consumers that fall behind skip the
+        # frames in between
+        self._frames: Deque[Frame] = collections.deque(maxlen=capacity)
+        self._sequence: int = 0
+
+        self._lock = threading.Lock()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def put(
+        self,
+        data: bytes,
+        dhash: Optional[int] = None,
+        thumbnail: Optional[np.ndarray] = None,
+    ) -> Optional[Frame]:
+        # The digest is computed once here rather than by every consumer.
+        # Returns None if the frame is the same as the latest one, as cameras
+        # may send the same image again.
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            if len(self._frames) > 0 and self._frames[-1]["sha256"] == sha256:
+                return None
+
+            self._sequence += 1
+            frame: Frame = {
+                "sequence": self._sequence,
+                "data": data,
+                "sha256": sha256,
+                "dhash": dhash,
+                "thumbnail": thumbnail,
+                "received_time": time.time(),
+            }
+            self._frames.append(frame)
+
+            async_waiters = self._async_waiters
+            self._async_waiters = []
+
+        wake_async_waiters(async_waiters)
+
+        return frame
+
+    def get_latest(self) -> Optional[Frame]:
+        with self._lock:
+            return self._frames[-1] if len(self._frames) > 0 else None
+
+    def get_frames(self) -> List[Frame]:
+        with self._lock:
+            return list(self._frames)
+
+    async def async_wait_for_frame(
+        self, after_sequence: int, timeout: Optional[float] = None
+    ) -> Optional[Frame]:
+        # Returns the latest frame if it is newer than after_sequence, waiting
+        # for one if necessary, or None on timeout.
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self._lock:
+                frame = self._get_frame_after(after_sequence)
+                if frame is not None:
+                    return frame
+
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(future, remaining)
+            except TimeoutError:
+                return None
+
+    def _get_frame_after(self, after_sequence: int) -> Optional[Frame]:
+        # Must be called with the lock held
+        if self._sequence <= after_sequence:
+            return None
+
+        return self._frames[-1]
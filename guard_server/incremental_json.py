@@ -0,0 +1,152 @@
+import json
+from typing import Any, List, Optional, TypedDict
+
+
+class JsonEvent(TypedDict):
+    key: str
+    # For string values, events with done set to False carry the next piece of
+    # the decoded text. The final event carries the complete value.
+    value: Any
+    done: bool
+
+
+class IncrementalJsonParser:
+    # Parses the top-level object of a JSON document as it arrives in chunks,
+    # so that each field can be used as soon as it is complete. Text around the
+    # object, such as a Markdown code fence, and trailing commas are ignored.
+    def __init__(self):
+        self._depth: int = 0
+        self._finished: bool = False
+
+        self._in_string: bool = False
+        self._escaped: bool = False
+        self._string_is_key: bool = False
+
+        # Raw characters of the current string, and how much of it has been
+        # emitted so far
+        self._string_chars: List[str] = []
+        self._emitted_length: int = 0
+
+        # Raw characters of the current value if it is not a string
+        self._value_chars: List[str] = []
+
+        self._key: Optional[str] = None
+
+    def feed(self, chunk: str) -> List[JsonEvent]:
+        events: List[JsonEvent] = []
+
+        for c in chunk:
+            if self._finished:
+                break
+
+            if self._depth == 0:
+                if c == "{":
+                    self._depth = 1
+
+            elif self._depth > 1:
+                self._feed_nested_value(c)
+
+            elif self._in_string:
+                self._feed_string(c, events)
+
+            elif c == '"':
+                self._in_string = True
+                self._string_is_key = self._key is None
+                self._string_chars = []
+                self._emitted_length = 0
+
+            elif c in ",}":
+                self._finish_value(events)
+                if c == "}":
+                    self._depth = 0
+                    self._finished = True
+
+            elif c in "{[":
+                self._depth += 1
+                self._value_chars.append(c)
+
+            elif c != ":" and not c.isspace():
+                self._value_chars.append(c)
+
+        # Emit the text of a string value received so far
+        if self._in_string and not self._string_is_key:
+            self._emit_delta(events)
+
+        return events
+
+    def _feed_nested_value(self, c: str) -> None:
+        self._value_chars.append(c)
+
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif c == "\\":
+                self._escaped = True
+            elif c == '"':
+                self._in_string = False
+
+        elif c == '"':
+            self._in_string = True
+        elif c in "{[":
+            self._depth += 1
+        elif c in "}]":
+            self._depth -= 1
+
+    def _feed_string(self, c: str, events: List[JsonEvent]) -> None:
+        if self._escaped:
+            self._escaped = False
+        elif c == "\\":
+            self._escaped = True
+        elif c == '"':
+            self._in_string = False
+            value = decode_string(self._string_chars)
+            if value is None:
+                # An invalid escape sequence, keep the raw text
+                value = "".join(self._string_chars)
+
+            if self._string_is_key:
+                self._key = value
+                return
+
+            self._emit_delta(events)
+            if self._key is not None:
+                events.append({"key": self._key, "value": value, "done": True})
+            self._key = None
+            return
+
+        self._string_chars.append(c)
+
+    def _emit_delta(self, events: List[JsonEvent]) -> None:
+        # Fails while the string ends within an escape sequence, in which case
+        # the text is emitted with the next chunk
+        text = decode_string(self._string_chars)
+        if text is None or len(text) <= self._emitted_length or self._key is None:
+            return
+
+        events.append(
+            {"key": self._key, "value": text[self._emitted_length :], "done": False}
+        )
+        self._emitted_length = len(text)
+
+    def _finish_value(self, events: List[JsonEvent]) -> None:
+        if self._key is None or len(self._value_chars) == 0:
+            return
+
+        raw_value = "".join(self._value_chars)
+        self._value_chars = []
+
+        try:
+            value = json.loads(raw_value)
+        except ValueError:
+            value = raw_value
+
+        events.append({"key": self._key, "value": value, "done": True})
+        self._key = None
+
+
+def decode_string(chars: List[str]) -> Optional[str]:
+    # Models often put raw newlines into strings, which strict JSON forbids
+    try:
+        return json.loads('"' + "".join(chars) + '"', strict=False)
+    except ValueError:
+        return None
@@ -0,0 +1,196 @@
+import collections
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Literal, Optional, Tuple
+
+# "always" syncs the log to disk on every flush, "interval" at most once per
+# fsync_interval and "never" leaves it to the operating system.
+FsyncPolicy = Literal["always", "interval", "never"]
+
+# Entries are untyped here to avoid a circular import with info_db
+Snapshot = Tuple[int, List[Any]]
+
+
+class InfoDbStore:
+    def __init__(
+        self,
+        directory: str,
+        fsync_policy: FsyncPolicy = "interval",
+        fsync_interval: float = 1.0,
+        flush_interval: float = 0.1,
+        snapshot_interval: float = 60.0,
+        snapshot_max_log_records: int = 1000,
+    ):
+        self._snapshot_path = os.path.join(directory, "snapshot.json")
+        self._log_path = os.path.join(directory, "wal.jsonl")
+        os.makedirs(directory, exist_ok=True)
+
+        self._fsync_policy = fsync_policy
+        self._fsync_interval = fsync_interval
+        self._flush_interval = flush_interval
+        self._snapshot_interval = snapshot_interval
+        self._snapshot_max_log_records = snapshot_max_log_records
+
+        # Appending to a deque is atomic, so the hot path does not take a lock
+        # or touch the disk.
+        self._pending_records: Deque[Tuple[int, Any]] = collections.deque()
+
+        self._log_file = open(self._log_path, "a", encoding="utf-8")
+        self._log_records: int = 0
+        self._log_synced: bool = True
+        self._last_fsync_time = time.monotonic()
+        self._last_snapshot_time = time.monotonic()
+
+        self._get_snapshot: Optional[Callable[[], Snapshot]] = None
+        self._writer_thread: Optional[threading.Thread] = None
+        self._writer_thread_should_run: bool = False
+
+    def load(self) -> Snapshot:
+        version = 0
+        entries: Dict[str, Any] = {}
+
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            version = snapshot["version"]
+            for entry in snapshot["entries"]:
+                entries[entry["endpoint"]] = entry
+
+        # Entries inserted together share a version, so records are compared
+        # with the snapshot rather than with each other
+        snapshot_version = version
+
+        valid_log_size = 0
+        with open(self._log_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A torn write of the last record before a crash
+                    break
+                valid_log_size += len(line)
+
+                record = json.loads(line)
+                if record["version"] <= snapshot_version:
+                    continue
+
+                version = record["version"]
+                entries[record["entry"]["endpoint"]] = record["entry"]
+                self._log_records += 1
+
+        # Drop the torn record so that new records start on a fresh line
+        self._log_file.truncate(valid_log_size)
+
+        return version, list(entries.values())
+
+    def start(self, get_snapshot: Callable[[], Snapshot]) -> None:
+        self._get_snapshot = get_snapshot
+        self._writer_thread_should_run = True
+        self._writer_thread = threading.Thread(
+            target=self._writer_thread_func, daemon=True
+        )
+        self._writer_thread.start()
+
+    def append(self, version: int, entry: Any) -> None:
+        # Must be called in version order
+        self._pending_records.append((version, entry))
+
+    def close(self) -> None:
+        if self._writer_thread is not None:
+            self._writer_thread_should_run = False
+            self._writer_thread.join()
+
+        self._flush(force_fsync=True)
+        self._log_file.close()
+
+    def _writer_thread_func(self) -> None:
+        while self._writer_thread_should_run:
+            time.sleep(self._flush_interval)
+
+            self._flush()
+
+            if self._log_records >= self._snapshot_max_log_records or (
+                self._log_records > 0
+                and time.monotonic() - self._last_snapshot_time
+                >= self._snapshot_interval
+            ):
+                self._compact()
+
+    def _flush(self, force_fsync: bool = False) -> None:
+        records = self._drain_pending_records()
+        if len(records) > 0:
+            self._write_log_records(self._log_file, records)
+            self._log_file.flush()
+            self._log_synced = False
+
+        if self._log_synced:
+            return
+
+        if (
+            force_fsync
+            or self._fsync_policy == "always"
+            or (
+                self._fsync_policy == "interval"
+                and time.monotonic() - self._last_fsync_time >= self._fsync_interval
+            )
+        ):
+            os.fsync(self._log_file.fileno())
+            self._log_synced = True
+            self._last_fsync_time = time.monotonic()
+
+    def _compact(self) -> None:
+        assert self._get_snapshot is not None
+
+        # Every record up to the snapshot version has been appended by now, so
+        # only the pending records after it need to be kept in the new log.
+        version, entries = self._get_snapshot()
+        records = [
+            record for record in self._drain_pending_records() if record[0] > version
+        ]
+
+        write_file_atomically(
+            self._snapshot_path,
+            json.dumps(
+                {"version": version, "entries": entries},
+                ensure_ascii=False,
+                default=str,
+            ),
+        )
+
+        self._log_file.close()
+        with open(self._log_path + ".tmp", "w", encoding="utf-8") as f:
+            self._write_log_records(f, records)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._log_path + ".tmp", self._log_path)
+        self._log_file = open(self._log_path, "a", encoding="utf-8")
+
+        self._log_records = len(records)
+        self._log_synced = True
+        self._last_snapshot_time = time.monotonic()
+
+    def _drain_pending_records(self) -> List[Tuple[int, Any]]:
+        records: List[Tuple[int, Any]] = []
+        while len(self._pending_records) > 0:
+            records.append(self._pending_records.popleft())
+
+        return records
+
+    def _write_log_records(self, f: Any, records: List[Tuple[int, Any]]) -> None:
+        f.writelines(
+            json.dumps(
+                {"version": version, "entry": entry}, ensure_ascii=False, default=str
+            )
+            + "\n"
+            for version, entry in records
+        )
+        self._log_records += len(records)
+
+
+def write_file_atomically(path: str, content: str) -> None:
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(path + ".tmp", path)
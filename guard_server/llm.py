@@ -1,8 +1,9 @@
-import json
-from typing import TypedDict
+from http import HTTPStatus
+from typing import Any, Dict, Iterator, Set, TypedDict, cast
 
 import dashscope
 import dashscope.api_entities
+from incremental_json import IncrementalJsonParser, JsonEvent
 
 PROMPT_SYSTEM_TEMPLATE = """
 你是一个先进的访客管理系统助手，负责根据输入的信息综合判断是否允许访客进入。你的决策需综合考虑以下因素：
@@ -31,20 +32,30 @@
 ```
 
 你需要首先综合所有信息分析当前状况，并基于谨慎和倾向于禁止的原则进行推理。然后给出准入 / 禁止 的决策，并向访客解释决策的理由。
-你的回复必须绝对严格遵循以下给出的JSON格式。
+你的回复必须绝对严格遵循以下给出的JSON格式，字段顺序也必须一致。
 JSON回复格式：
 
 ```json
-{{
-    "reasoning": "对当前情况的谨慎逐步推理过程，力求详细",
-    "decision": "准入 / 禁止",
-    "explanation": "向访客口头说明的内容，请尽可能热情，不要那么正式。",
-}}
+{response_format}
 ```
 
 请保证回复能够被Python的json.loads解析。
 """
 
+RESPONSE_FORMAT_REASONING_FIRST = """{
+    "reasoning": "对当前情况的谨慎逐步推理过程，力求详细",
+    "decision": "准入 / 禁止",
+    "explanation": "向访客口头说明的内容，请尽可能热情，不要那么正式。",
+}"""
+
+# With the decision and the explanation first, the gate can be actuated and
+# the explanation spoken while the reasoning is still being generated.
+RESPONSE_FORMAT_DECISION_FIRST = """{
+    "decision": "准入 / 禁止",
+    "explanation": "向访客口头说明的内容，请尽可能热情，不要那么正式。",
+    "reasoning": "对当前情况的谨慎逐步推理过程，力求详细",
+}"""
+
 
 class LLMResponse(TypedDict):
     reasoning: str
@@ -53,7 +64,24 @@ class LLMResponse(TypedDict):
 
 
 class LLM:
+    def __init__(self, decision_first: bool = True):
+        self._response_format = (
+            RESPONSE_FORMAT_DECISION_FIRST
+            if decision_first
+            else RESPONSE_FORMAT_REASONING_FIRST
+        )
+
     def generate(self, info: str) -> LLMResponse:
+        result: Dict[str, Any] = {}
+        for event in self.generate_stream(info):
+            if event["done"]:
+                result[event["key"]] = event["value"]
+
+        return cast(LLMResponse, result)
+
+    def generate_stream(self, info: str) -> Iterator[JsonEvent]:
+        # Yields the fields of the response as they are generated, and the
+        # pieces of the string fields in between.
         messages = [
             {
                 "role": "system",
@@ -61,23 +89,33 @@ def generate(self, info: str) -> LLMResponse:
             },
             {
                 "role": "user",
-                "content": PROMPT_USER_TEMPLATE.format(info=info),
+                "content": PROMPT_USER_TEMPLATE.format(
+                    info=info, response_format=self._response_format
+                ),
             },
         ]
 
-        response = dashscope.Generation.call(
+        responses = dashscope.Generation.call(
             model="qwen-max",
             messages=messages,  # type: ignore
+            stream=True,
+            incremental_output=True,
         )
 
-        ans: str = response.output.text  # type: ignore
+        parser = IncrementalJsonParser()
+        keys: Set[str] = set()
 
-        # Remove everything out of { and }
-        ans = ans[ans.find("{") : ans.rfind("}") + 1]
+        for response in responses:
+            if response.status_code != HTTPStatus.OK:  # type: ignore
+                raise RuntimeError(response.message)  # type: ignore
 
-        # Replace all newlines with spaces
-        ans = ans.replace("\n", " ")
+            chunk: str = response.output.text  # type: ignore
 
-        result = json.loads(ans)
+            for event in parser.feed(chunk):
+                if event["done"]:
+                    keys.add(event["key"])
+                yield event
 
-        return result
+        missing_keys = set(LLMResponse.__annotations__) - keys
+        if len(missing_keys) > 0:
+            raise ValueError(f"Missing fields in LLM response: {missing_keys}")
@@ -1,24 +1,50 @@
+import asyncio
 import base64
-import datetime
+import concurrent.futures
+import functools
 import hashlib
 import json
 import os
-import threading
 import time
-import urllib.parse
-from typing import List
-
-import alibabacloud_facebody20191230.client
-import alibabacloud_facebody20191230.models
-import alibabacloud_tea_openapi.models
-import alibabacloud_tea_util.models
-import holidays
-from comm import ZmqComm
+import traceback
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    cast,
+)
+
+from calendar_info import CalendarInfo, ChangeGranularity
+from comm import AsyncZmqComm
+from decision_cache import DecisionCache
+from decision_trigger import DecisionTrigger
+from face_index import FaceIndex, ThumbnailEmbedder, load_references
+from face_verifier import CloudFaceVerifier
+from frame_pipeline import FramePipeline, decode_frame, select_informative_frames
+from frame_store import Frame, FrameStore
+from image_preprocessor import ImagePreprocessor, ImageVariantSpec, make_variant
 from info_db import InfoDb, InfoDbEntry
-from llm import LLM
-from schemas import ActuatorCommand, SensorReport
+from info_db_store import InfoDbStore
+from llm import LLM, LLMResponse
+from motion_gate import MotionGate, is_presence_reported
+from perceptual_hash import PerceptualHashCache
+from schemas import (
+    ActuatorCommand,
+    QuestionManifest,
+    QuestionManifestEntry,
+    QuestionSoundRequest,
+    SensorReport,
+)
+from speech_stream import SpeechStream
 from tts import TTS
-from vlm import VLM
+from tts_cache import TtsCache
+from vlm import VLM, VLMResponse
 
 COMM_BROKER_HOST = "10.8.0.5"
 COMM_BROKER_BACKEND_PORT = 5556
@@ -38,35 +64,221 @@
     "最后一个问题了，请问，",
 ]
 
+# Endpoints whose changes trigger a new admission decision, and the debounce
+# window in seconds in which changes are collected into a single decision
+LLM_TRIGGER_ENDPOINTS = {"face", "question_answer", "vlm"}
+LLM_TRIGGER_DEBOUNCE = 0.3
+LLM_TRIGGER_MAX_DELAY = 2.0
+
+# The calendar endpoint changes every day. It is not a trigger, so this only
+# matters to consumers that wait for changes of the calendar.
+CALENDAR_CHANGE_GRANULARITY: ChangeGranularity = "day"
+
+# Whether the LLM is asked for its decision before its reasoning, so that the
+# gate can be actuated before the whole response has been generated
+LLM_DECISION_FIRST = True
+
+# Decisions are reused for situations that look the same, for at most
+# DECISION_CACHE_TTL seconds. Endpoints in DECISION_CACHE_UNCACHED_ENDPOINTS
+# opt out of the cache.
+DECISION_CACHE_SIZE = 256
+DECISION_CACHE_TTL = 600.0
+DECISION_CACHE_UNCACHED_ENDPOINTS: Set[str] = set()
+
+# Seconds between checks whether the sounds of the questions changed. The
+# manifest of the sounds is only published when they did, or on request.
+QUESTION_MANIFEST_INTERVAL = 60
+
+# Question sounds generated at once during the warm-up at startup, which must
+# not exceed the concurrency limit of the TTS service
+WARM_UP_CONCURRENCY = 3
+
+# Latest camera frames kept in memory, and the minimum seconds between two
+# analyses of frames by the frame pipeline, which runs the face and VLM stages
+# on the same frame
+FRAME_STORE_CAPACITY = 8
+FRAME_ANALYSIS_MIN_INTERVAL = 1.0
+
+# Frames are downscaled to at most max_edge pixels and re-encoded before they
+# are uploaded by the face and VLM stages. Face uploads are not cropped: the
+# only region at hand is the one that changed since the last analyzed frame,
+# which may be a hand or a bag rather than the face. Cropping needs a face
+# detector to provide the region.
+IMAGE_UPLOAD_SPECS: Dict[str, ImageVariantSpec] = {
+    "face": {"max_edge": 640, "jpeg_quality": 90, "crop_roi": False, "roi_margin": 0.2},
+    "vlm": {"max_edge": 1024, "jpeg_quality": 80, "crop_roi": False, "roi_margin": 0.0},
+}
+FACE_REFERENCE_UPLOAD_SPEC: ImageVariantSpec = {
+    **IMAGE_UPLOAD_SPECS["face"],
+    "crop_roi": False,
+}
+
+# The VLM stage analyzes frames at most once per VLM_BATCH_INTERVAL seconds,
+# and sends up to VLM_BATCH_SIZE frames of that interval which differ the most
+# in a single request, so that it sees how the scene developed. A
+# VLM_BATCH_SIZE of 1 only sends the latest frame.
+VLM_BATCH_SIZE = 3
+VLM_BATCH_INTERVAL = 5.0
+
+# Results of the VLM stage kept per perceptual hash of the analyzed frame, and
+# how many bits the hash of a frame may differ to reuse them. Face results are
+# never reused, as the hash covers the whole frame and barely changes when a
+# different person stands in the same spot.
+VISION_CACHE_SIZE = 128
+VISION_CACHE_MAX_DISTANCE = 6
+
+# Reference images of the residents, stored as <RESIDENTS_DIR>/<name>/<image>.
+# face_ref.jpg is also used as the reference of a resident if it exists.
+RESIDENTS_DIR = "residents"
+
+# Frames whose face embedding is at least FACE_MATCH_THRESHOLD similar to a
+# resident match, and those below FACE_REJECT_THRESHOLD do not. Scores in
+# between are verified against the FACE_VERIFICATION_CANDIDATES most similar
+# residents by the cloud API if FACE_CLOUD_VERIFICATION is set.
+#
+# Local matching is inactive: the only embedder is the thumbnail embedder,
+# whose scores reflect the background rather than the face. With it the
+# thresholds are ignored, and every frame with a face is verified by the cloud
+# API against every resident, the best scoring first.
+FACE_MATCH_THRESHOLD = 0.95
+FACE_REJECT_THRESHOLD = -1.0
+FACE_VERIFICATION_CANDIDATES = 3
+FACE_CLOUD_VERIFICATION = True
+FACE_CLOUD_CONFIDENCE_THRESHOLD = 61
+
+# Frames only reach the face and VLM stages if at least
+# MOTION_MIN_CHANGED_FRACTION of their pixels changed by more than
+# MOTION_PIXEL_THRESHOLD since the last frame that did, or if the environment
+# sensor reports a person present and MOTION_GATE_USE_PRESENCE is set
+MOTION_MIN_CHANGED_FRACTION = 0.02
+MOTION_PIXEL_THRESHOLD = 25
+MOTION_GATE_USE_PRESENCE = True
+
+# Seconds between printing the counters of the pipeline stages
+STATS_INTERVAL = 60
+
+# Seconds to wait before a task carries on after a failure, e.g. of a cloud
+# service
+TASK_RETRY_DELAY = 5
+
+# Directory where the state of the server is persisted across restarts
+DATA_DIR = "data"
+
 DEFAULT_INFO: List[InfoDbEntry] = []
 
-info_db = InfoDb()
-comm = ZmqComm(
+T = TypeVar("T")
+
+STOP_ITERATION = object()
+
+info_db = InfoDb(store=InfoDbStore(os.path.join(DATA_DIR, "info_db")))
+tts_cache = TtsCache(os.path.join(DATA_DIR, "tts_cache"))
+frame_store = FrameStore(capacity=FRAME_STORE_CAPACITY)
+motion_gate = MotionGate(MOTION_MIN_CHANGED_FRACTION, MOTION_PIXEL_THRESHOLD)
+frame_pipeline = FramePipeline(
+    frame_store,
+    info_db,
+    min_interval=FRAME_ANALYSIS_MIN_INTERVAL,
+    motion_gate=motion_gate,
+    # Looked up on call, as the function is defined below
+    is_person_present=lambda: is_person_present(),
+)
+# Keeps the variants of all stored frames, which the VLM stage may send
+image_preprocessor = ImagePreprocessor(
+    IMAGE_UPLOAD_SPECS, max_frames=FRAME_STORE_CAPACITY
+)
+# Frames that look like an analyzed one reuse its VLM result
+vlm_cache: PerceptualHashCache[VLMResponse] = PerceptualHashCache(
+    max_size=VISION_CACHE_SIZE, max_distance=VISION_CACHE_MAX_DISTANCE
+)
+question_manifest: List[QuestionManifestEntry] = []
+question_sounds: Dict[str, Tuple[QuestionManifestEntry, bytes]] = {}
+comm = AsyncZmqComm(
     broker_host=COMM_BROKER_HOST,
     broker_backend_port=COMM_BROKER_BACKEND_PORT,
     broker_frontend_port=COMM_BROKER_FRONTEND_PORT,
+    name="guard_server",
 )
 
 
-def main() -> None:
-    comm.connect()
+async def main() -> None:
+    await comm.connect()
     comm.register_receive_callback("sensor", sensor_comm_callback)
+    # Only the latest camera frame is of interest
+    comm.register_receive_callback(
+        "sensor/camera",
+        sensor_comm_callback,
+        max_queue_size=1,
+        overflow_policy="drop_oldest",
+    )
+    comm.register_receive_callback("request/question", question_request_callback)
 
     for entry in DEFAULT_INFO:
         info_db.insert(entry)
 
-    thread_list: List[threading.Thread] = [
-        threading.Thread(target=calendar_thread),
-        threading.Thread(target=face_thread),
-        threading.Thread(target=llm_thread),
-        threading.Thread(target=qa_thread),
-        threading.Thread(target=vlm_thread),
+    try:
+        await warm_up()
+
+        print("Guard server ready")
+
+        # If any task fails, the others are cancelled
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(calendar_task())
+            task_group.create_task(frame_task())
+            task_group.create_task(llm_task())
+            task_group.create_task(qa_task())
+            task_group.create_task(stats_task())
+
+    finally:
+        await comm.disconnect()
+        info_db.close()
+
+
+async def warm_up() -> None:
+    # Generates the sounds of all question prompts in parallel before the
+    # first visitor can arrive, which only takes long on a cold cache
+    tts = TTS(cache=tts_cache, max_connections=WARM_UP_CONCURRENCY)
+
+    texts = [
+        QUESTION_ORDER_PREFIX_LIST[order] + question
+        for question in QUESTION_LIST
+        for order in range(3)
     ]
-    for thread in thread_list:
-        thread.start()
+
+    loop = asyncio.get_running_loop()
+    start_time = time.perf_counter()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(WARM_UP_CONCURRENCY) as executor:
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(executor, warm_up_question_sound, tts, text)
+                    for text in texts
+                )
+            )
+
+    finally:
+        tts.close()
+
+    print(
+        f"Warmed up {len(texts)} question sounds in "
+        f"{time.perf_counter() - start_time:.2f} s"
+    )
+
+
+def warm_up_question_sound(tts: TTS, text: str) -> None:
+    start_time = time.perf_counter()
+
+    try:
+        tts.generate_bytes(text)
+    except Exception:
+        # The qa task tries again later
+        traceback.print_exc()
+        return
+
+    print(f"Warmed up sound of {text} in {time.perf_counter() - start_time:.2f} s")
 
 
-def sensor_comm_callback(msg_str: str) -> None:
+async def sensor_comm_callback(msg_str: str, attachments: List[memoryview]) -> None:
     msg = json.loads(msg_str)
     if msg["messageId"] != "SensorReport":
         return
@@ -75,9 +287,17 @@ def sensor_comm_callback(msg_str: str) -> None:
 
     match msg["sensorType"]:
         case "camera":
-            base64_img = str(msg["data"]).encode()
-            with open("img.jpg", "wb") as f:
-                f.write(base64.decodebytes(base64_img))
+            if len(attachments) > 0:
+                img = attachments[0]
+            else:
+                # Legacy cameras send the image as base64 in the data field
+                img = memoryview(base64.decodebytes(str(msg["data"]).encode()))
+
+            # Copied once out of the received message, and shared with all
+            # consumers from then on
+            img_data = bytes(img)
+            dhash, thumbnail = await asyncio.to_thread(decode_frame, img_data)
+            frame_store.put(img_data, dhash, thumbnail)
 
         case _:
             info_db.insert(
@@ -89,240 +309,405 @@ def sensor_comm_callback(msg_str: str) -> None:
             )
 
 
-def calendar_thread() -> None:
+async def calendar_task() -> None:
+    calendar_info = CalendarInfo(granularity=CALENDAR_CHANGE_GRANULARITY)
+
+    info_db.register_computed_endpoint(
+        "calendar",
+        "本系统用于获取当前时间和日期信息",
+        calendar_info.get_data,
+    )
+
     while True:
-        time.sleep(1)
-
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y-%m-%d")
-        holidays_cn = holidays.country_holidays("CN")
-        holiday_name = holidays_cn.get(date_str)
-        info_db.insert(
-            {
-                "endpoint": "calendar",
-                "description": "本系统用于获取当前时间和日期信息",
-                "data": {
-                    "date_time": now.strftime("%Y-%m-%d %I%p %A"),
-                    "holiday": holiday_name or "无节日",
-                },
-            }
+        await asyncio.sleep(calendar_info.get_seconds_until_next_change())
+
+        info_db.mark_changed("calendar")
+
+
+async def frame_task() -> None:
+    # Residents are matched locally, and only frames with a borderline score
+    # are verified by the cloud API
+    face_index = FaceIndex(ThumbnailEmbedder())
+    references = await asyncio.to_thread(load_references, RESIDENTS_DIR)
+    if os.path.exists("face_ref.jpg"):
+        references.setdefault("resident", []).append(
+            await asyncio.to_thread(read_file, "face_ref.jpg")
         )
+    # Reference images are uploaded for verification as well, so they are
+    # shrunk once like the frames
+    references = await asyncio.to_thread(shrink_references, references)
+    await asyncio.to_thread(face_index.build, references)
+
+    face_verifier = CloudFaceVerifier() if FACE_CLOUD_VERIFICATION else None
 
+    vlm = VLM()
 
-def face_thread() -> None:
-    config = alibabacloud_tea_openapi.models.Config(
-        access_key_id=os.environ.get("ALIBABA_CLOUD_ACCESS_KEY_ID") or "",
-        access_key_secret=os.environ.get("ALIBABA_CLOUD_ACCESS_KEY_SECRET") or "",
-        endpoint="facebody.cn-shanghai.aliyuncs.com",
-        region_id="cn-shanghai",
+    frame_pipeline.add_stage(
+        "face",
+        "本系统用于识别访客的人脸信息，以便进行访客管理",
+        functools.partial(analyze_face, face_index, face_verifier),
+    )
+    frame_pipeline.add_stage(
+        "vlm",
+        "本系统用于分析图片中的场景，以便进行安防推理",
+        functools.partial(analyze_vlm, vlm),
+        min_interval=VLM_BATCH_INTERVAL,
     )
-    runtime_options = alibabacloud_tea_util.models.RuntimeOptions()
 
-    last_img_sha256: str = ""
+    await frame_pipeline.run()
 
-    while True:
-        time.sleep(5)
 
-        if not os.path.exists("img.jpg"):
-            info_db.insert(
-                {
-                    "endpoint": "face",
-                    "description": "本系统用于识别访客的人脸信息，以便进行访客管理",
-                    "data": "缺失",
-                }
-            )
-            continue
+def shrink_references(references: Dict[str, List[bytes]]) -> Dict[str, List[bytes]]:
+    return {
+        resident: [
+            make_variant(img, FACE_REFERENCE_UPLOAD_SPEC, None) for img in images
+        ]
+        for resident, images in references.items()
+    }
 
-        img_hash = hash_with_sha256(open("img.jpg", "rb").read())
-        if img_hash == last_img_sha256:
-            print("No new image")
-            continue
-        last_img_sha256 = img_hash
-
-        stream_a = open("img.jpg", "rb")
-        stream_b = open("face_ref.jpg", "rb")
-        compare_face_request = (
-            alibabacloud_facebody20191230.models.CompareFaceAdvanceRequest(
-                image_urlaobject=stream_a,
-                image_urlbobject=stream_b,
-            )
-        )
 
-        client = alibabacloud_facebody20191230.client.Client(config)
-        try:
-            response = client.compare_face_advance(
-                compare_face_request, runtime_options
-            )
-            confidence = response.body.data.confidence
-            assert isinstance(confidence, float)
-
-            print(response.body.data)
-
-            if confidence > 61:
-                info_db.insert(
-                    {
-                        "endpoint": "face",
-                        "description": "本系统用于识别访客的人脸信息，以便进行访客管理",
-                        "data": "匹配",
-                    }
-                )
+async def analyze_face(
+    face_index: FaceIndex, face_verifier: Optional[CloudFaceVerifier], frame: Frame
+) -> str:
+    return await asyncio.to_thread(match_face, face_index, face_verifier, frame)
 
-            else:
-                info_db.insert(
-                    {
-                        "endpoint": "face",
-                        "description": "本系统用于识别访客的人脸信息，以便进行访客管理",
-                        "data": "不匹配",
-                    }
-                )
 
-        except Exception:
-            info_db.insert(
-                {
-                    "endpoint": "face",
-                    "description": "本系统用于识别访客的人脸信息，以便进行访客管理",
-                    "data": "缺失",
-                }
-            )
+async def analyze_vlm(vlm: VLM, frame: Frame) -> VLMResponse:
+    frames = select_informative_frames(
+        frame,
+        frame_store.get_frames(),
+        VLM_BATCH_SIZE,
+        VLM_BATCH_INTERVAL,
+        MOTION_MIN_CHANGED_FRACTION,
+        MOTION_PIXEL_THRESHOLD,
+    )
+
+    # Only results of single frames are reused, as those of several frames
+    # depend on how the scene developed
+    if len(frames) == 1:
+        vlm_response = vlm_cache.get(frame["dhash"])
+        if vlm_response is not None:
+            print("Similar frame, reusing VLM result")
+            return vlm_response
+
+    vlm_response = await asyncio.to_thread(generate_vlm_response, vlm, frames)
+    if len(frames) == 1:
+        vlm_cache.put(frame["dhash"], vlm_response)
+
+    print(vlm_response)
+
+    return vlm_response
+
+
+def generate_vlm_response(vlm: VLM, frames: List[Frame]) -> VLMResponse:
+    return vlm.generate_frames(
+        [
+            (frame["sequence"], image_preprocessor.get_variant(frame, "vlm"))
+            for frame in frames
+        ]
+    )
+
+
+def match_face(
+    face_index: FaceIndex,
+    face_verifier: Optional[CloudFaceVerifier],
+    frame: Frame,
+) -> str:
+    discriminative = face_index.is_discriminative()
+    matches = face_index.search(
+        frame["data"],
+        top_k=FACE_VERIFICATION_CANDIDATES if discriminative else None,
+    )
+    if matches is None:
+        return "缺失"
 
+    if len(matches) == 0:
+        return "不匹配"
 
-def llm_thread() -> None:
-    llm = LLM()
-    tts = TTS()
+    print(
+        "Face scores:",
+        {match["resident"]: round(match["score"], 3) for match in matches},
+    )
+
+    if discriminative and matches[0]["score"] >= FACE_MATCH_THRESHOLD:
+        return "匹配"
+
+    if discriminative and matches[0]["score"] < FACE_REJECT_THRESHOLD:
+        return "不匹配"
+
+    if face_verifier is None:
+        return "不匹配"
+
+    img = image_preprocessor.get_variant(frame, "face")
+    for match in matches:
+        confidence = face_verifier.compare(img, match["reference_image"])
+        if confidence > FACE_CLOUD_CONFIDENCE_THRESHOLD:
+            return "匹配"
 
-    last_info_hash: int = 0
+    return "不匹配"
+
+
+async def llm_task() -> None:
+    llm = LLM(decision_first=LLM_DECISION_FIRST)
+    tts = TTS(cache=tts_cache)
+
+    decision_cache: DecisionCache[LLMResponse] = DecisionCache(
+        max_size=DECISION_CACHE_SIZE,
+        ttl=DECISION_CACHE_TTL,
+        uncached_endpoints=DECISION_CACHE_UNCACHED_ENDPOINTS,
+    )
+
+    trigger = DecisionTrigger(
+        info_db,
+        endpoints=LLM_TRIGGER_ENDPOINTS,
+        debounce=LLM_TRIGGER_DEBOUNCE,
+        max_delay=LLM_TRIGGER_MAX_DELAY,
+        normalize=decision_cache.normalize_entry,
+    )
 
     while True:
-        time.sleep(5)
+        await trigger.wait()
 
-        info = json.dumps(info_db.get(), sort_keys=True)
-        info_hash = hash(info)
-        if info_hash == last_info_hash:
-            print("No new info")
-            continue
-        last_info_hash = info_hash
+        # A failed decision is not retried for the same situation, and the
+        # delay bounds the rate of failing requests
+        try:
+            await decide(llm, tts, decision_cache)
+        except Exception:
+            traceback.print_exc()
+            await asyncio.sleep(TASK_RETRY_DELAY)
+
+
+async def decide(
+    llm: LLM, tts: TTS, decision_cache: DecisionCache[LLMResponse]
+) -> None:
+    # The face and VLM results are inserted together, but the throttled VLM
+    # stage may keep a result of an older frame, whose sequence its entry tells
+    frame_analysis = frame_pipeline.get_latest_analysis()
+    if frame_analysis is not None:
+        print(f"Deciding on frame {frame_analysis['sequence']}")
+
+    info_entries = info_db.get()
+
+    cache_key = decision_cache.make_key(info_entries)
+    llm_response = decision_cache.get(cache_key)
+    if llm_response is not None:
+        await send_gate_command(llm_response["decision"])
+
+        speech_stream = SpeechStream(tts, send_explanation_audio)
+        speech_stream.feed(llm_response["explanation"])
+        await speech_stream.finish()
+
+    else:
+        info = json.dumps(info_entries, sort_keys=True)
+
+        # Each field is acted on as soon as it has been generated, rather
+        # than after the whole response
+        result: Dict[str, Any] = {}
+        speech_stream = SpeechStream(tts, send_explanation_audio)
+        explanation_task: Optional[asyncio.Task] = None
+        try:
+            async for event in iterate_in_thread(llm.generate_stream(info)):
+                if not event["done"]:
+                    # The explanation is spoken while it is being generated
+                    if event["key"] == "explanation":
+                        speech_stream.feed(event["value"])
 
-        llm_response = llm.generate(info)
+                    continue
 
-        print(llm_response)
+                result[event["key"]] = event["value"]
 
-        if llm_response["decision"] == "准入":
-            gate_command: ActuatorCommand = {
-                "endpoint": "gate",
-                "messageId": "ActuatorCommand",
-                "data": {
-                    "command": "unlock",
-                },
-            }
+                match event["key"]:
+                    case "decision":
+                        await send_gate_command(event["value"])
 
-        else:
-            gate_command = {
-                "endpoint": "gate",
-                "messageId": "ActuatorCommand",
-                "data": {
-                    "command": "lock",
-                },
-            }
+                    case "explanation":
+                        explanation_task = asyncio.create_task(speech_stream.finish())
 
-        comm.send("actuator", json.dumps(gate_command))
+            if explanation_task is None:
+                explanation_task = asyncio.create_task(speech_stream.finish())
+            await explanation_task
 
-        if os.path.exists("llm.mp3"):
-            os.remove("llm.mp3")
+        except BaseException:
+            # A failed response must neither leave the speech stream waiting
+            # for more text nor the utterance without its end
+            if explanation_task is not None:
+                explanation_task.cancel()
+            await speech_stream.cancel()
+            raise
 
-        tts.generate(llm_response["explanation"], "llm.mp3")
+        llm_response = cast(LLMResponse, result)
+        decision_cache.put(cache_key, llm_response)
 
-        with open("llm.mp3", "rb") as f:
-            sound_data = f.read()
+    print(llm_response)
+    print(decision_cache.get_stats())
+    print(tts_cache.get_stats())
 
-        sound_command: ActuatorCommand = {
-            "endpoint": "explanation",
+
+async def send_gate_command(decision: str) -> None:
+    if decision == "准入":
+        gate_command: ActuatorCommand = {
+            "endpoint": "gate",
             "messageId": "ActuatorCommand",
             "data": {
-                "sound": base64.encodebytes(sound_data).decode(),
+                "command": "unlock",
             },
         }
 
-        comm.send("actuator", json.dumps(sound_command))
+    else:
+        gate_command = {
+            "endpoint": "gate",
+            "messageId": "ActuatorCommand",
+            "data": {
+                "command": "lock",
+            },
+        }
+
+    await comm.send("actuator/gate", json.dumps(gate_command))
+
 
+async def send_explanation_audio(
+    utterance: str, sequence: int, sound_data: Optional[bytes]
+) -> None:
+    # The sound of an explanation is sent in chunks of one or more sentences,
+    # followed by a chunk without sound that marks the end of the utterance.
+    sound_command: ActuatorCommand = {
+        "endpoint": "explanation",
+        "messageId": "ActuatorCommand",
+        "data": {
+            "utterance": utterance,
+            "sequence": sequence,
+            "last": sound_data is None,
+        },
+    }
 
-def qa_thread() -> None:
-    tts = TTS()
+    attachments: List[bytes] = []
+    if sound_data is not None:
+        sound_command["attachments"] = [{"name": "sound", "contentType": "audio/mpeg"}]
+        attachments.append(sound_data)
+
+    await comm.send("actuator/explanation", json.dumps(sound_command), attachments)
+
+
+async def qa_task() -> None:
+    tts = TTS(cache=tts_cache)
 
     while True:
-        time.sleep(5)
-
-        # Generate sound files for each question
-        for question in QUESTION_LIST:
-            for order in range(3):
-                order_prefix = QUESTION_ORDER_PREFIX_LIST[order]
-                text = order_prefix + question
-                file_name = (
-                    hash_with_sha256(urllib.parse.quote(text).encode())[:32] + ".mp3"
-                )
-                if os.path.exists(file_name):
-                    continue
+        try:
+            await update_question_sounds(tts)
+        except Exception:
+            traceback.print_exc()
+            await asyncio.sleep(TASK_RETRY_DELAY)
+            continue
 
-                tts.generate(text, file_name)
+        await asyncio.sleep(QUESTION_MANIFEST_INTERVAL)
 
-        # Send questions to user
-        for question in QUESTION_LIST:
-            for order in range(3):
-                order_prefix = QUESTION_ORDER_PREFIX_LIST[order]
-                text = order_prefix + question
-                file_name = (
-                    hash_with_sha256(urllib.parse.quote(text).encode())[:32] + ".mp3"
-                )
-                with open(file_name, "rb") as f:
-                    sound_data = f.read()
-
-                sound_command: ActuatorCommand = {
-                    "endpoint": "question",
-                    "messageId": "ActuatorCommand",
-                    "data": {
-                        "order": order,
-                        "question": question,
-                        "sound": base64.encodebytes(sound_data).decode(),
-                    },
-                }
 
-                comm.send("actuator", json.dumps(sound_command))
+async def update_question_sounds(tts: TTS) -> None:
+    global question_manifest, question_sounds
 
+    # The sound of each prompt is only generated once, so this is cheap
+    # unless the cache lost it and the new sound differs
+    manifest: List[QuestionManifestEntry] = []
+    sounds: Dict[str, Tuple[QuestionManifestEntry, bytes]] = {}
+    for question in QUESTION_LIST:
+        for order in range(3):
+            order_prefix = QUESTION_ORDER_PREFIX_LIST[order]
+            text = order_prefix + question
+            sound_data = await asyncio.to_thread(tts.generate_bytes, text)
 
-def vlm_thread() -> None:
-    vlm = VLM()
+            entry: QuestionManifestEntry = {
+                "question": question,
+                "order": order,
+                "sha256": hash_with_sha256(sound_data),
+            }
+            manifest.append(entry)
+            sounds[entry["sha256"]] = (entry, sound_data)
+
+    if manifest != question_manifest:
+        question_manifest = manifest
+        question_sounds = sounds
+        await send_question_manifest()
+
+
+async def question_request_callback(
+    msg_str: str, attachments: List[memoryview]
+) -> None:
+    msg = json.loads(msg_str)
+    if msg["messageId"] != "QuestionSoundRequest":
+        return
+
+    msg: QuestionSoundRequest
+
+    if len(msg["sha256s"]) == 0:
+        await send_question_manifest()
+        return
+
+    for sha256 in msg["sha256s"]:
+        if sha256 not in question_sounds:
+            continue
+
+        entry, sound_data = question_sounds[sha256]
+
+        sound_command: ActuatorCommand = {
+            "endpoint": "question",
+            "messageId": "ActuatorCommand",
+            "data": entry,
+            "attachments": [{"name": "sound", "contentType": "audio/mpeg"}],
+        }
+
+        await comm.send("actuator/question", json.dumps(sound_command), [sound_data])
+
+
+async def send_question_manifest() -> None:
+    # Only the hashes are published, sound clients request the sounds they miss
+    manifest: QuestionManifest = {
+        "endpoint": "question",
+        "messageId": "QuestionManifest",
+        "questions": question_manifest,
+    }
 
-    last_img_sha256: str = ""
+    await comm.send("actuator/question", json.dumps(manifest))
 
+
+async def stats_task() -> None:
     while True:
-        time.sleep(5)
+        await asyncio.sleep(STATS_INTERVAL)
 
-        if not os.path.exists("img.jpg"):
-            info_db.insert(
+        print(
+            json.dumps(
                 {
-                    "endpoint": "vlm",
-                    "description": "本系统用于分析图片中的场景，以便进行安防推理",
-                    "data": "缺失",
+                    # Drops show subscriptions that do not keep up
+                    "comm": comm.get_channel_stats(),
+                    "frame_pipeline": frame_pipeline.get_stats(),
+                    "image_preprocessor": image_preprocessor.get_stats(),
+                    "vlm_cache": vlm_cache.get_stats(),
                 }
             )
-            continue
+        )
 
-        img_hash = hash_with_sha256(open("img.jpg", "rb").read())
-        if img_hash == last_img_sha256:
-            print("No new image")
-            continue
-        last_img_sha256 = img_hash
 
-        vlm_response = vlm.generate("img.jpg")
+def is_person_present() -> bool:
+    if not MOTION_GATE_USE_PRESENCE:
+        return False
 
-        print(vlm_response)
+    entry = info_db.get_endpoint("Environment")
+    return entry is not None and is_presence_reported(entry["data"])
 
-        info_db.insert(
-            {
-                "endpoint": "vlm",
-                "description": "本系统用于分析图片中的场景，以便进行安防推理",
-                "data": vlm_response,
-            }
-        )
+
+async def iterate_in_thread(iterator: Iterator[T]) -> AsyncIterator[T]:
+    # Runs a blocking iterator, e.g. a streaming response, without blocking the
+    # event loop
+    while True:
+        item = await asyncio.to_thread(next, iterator, STOP_ITERATION)
+        if item is STOP_ITERATION:
+            return
+
+        yield cast(T, item)
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
 
 
 def hash_with_sha256(data: bytes):
@@ -334,4 +719,4 @@ def hash_with_sha256(data: bytes):
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+import asyncio
+import traceback
+import uuid
+from typing import Awaitable, Callable, Optional
+
+from tts import TTS, SentenceSplitter
+
+# Sends the audio of a chunk of an utterance, or None after the last chunk
+SendAudio = Callable[[str, int, Optional[bytes]], Awaitable[None]]
+
+
+class SpeechStream:
+    # Synthesizes text that arrives in pieces sentence by sentence, with up to
+    # max_concurrency chunks at once, and sends the audio of each chunk in order
+    # as soon as it is ready, so that playback can start after the first
+    # sentence rather than after the whole text.
+    def __init__(self, tts: TTS, send_audio: SendAudio, max_concurrency: int = 3):
+        self._tts = tts
+        self._send_audio = send_audio
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        self._utterance = uuid.uuid4().hex
+        self._splitter = SentenceSplitter()
+        # Sequence of the next chunk to send
+        self._sequence: int = 0
+
+        # Synthesis tasks in the order of their text, None marks the end
+        self._synthesis_tasks: asyncio.Queue[
+            Optional[asyncio.Task[Optional[bytes]]]
+        ] = asyncio.Queue()
+        self._sender_task = asyncio.create_task(self._send_in_order())
+
+    def feed(self, text: str) -> None:
+        for chunk in self._splitter.feed(text):
+            self._start_synthesis(chunk)
+
+    async def finish(self) -> None:
+        for chunk in self._splitter.flush():
+            self._start_synthesis(chunk)
+
+        self._synthesis_tasks.put_nowait(None)
+        await self._sender_task
+
+    async def cancel(self) -> None:
+        # Ends the utterance early, e.g. when the text stops arriving because
+        # of an error, so that the audio sent so far is followed by the end of
+        # the utterance instead of leaving it open
+        if self._sender_task.done():
+            return
+
+        self._sender_task.cancel()
+        await asyncio.gather(self._sender_task, return_exceptions=True)
+
+        await self._send_audio(self._utterance, self._sequence, None)
+
+    def _start_synthesis(self, text: str) -> None:
+        self._synthesis_tasks.put_nowait(asyncio.create_task(self._synthesize(text)))
+
+    async def _synthesize(self, text: str) -> Optional[bytes]:
+        # A sentence that cannot be synthesized is left out rather than
+        # ending the whole utterance
+        async with self._semaphore:
+            try:
+                return await asyncio.to_thread(self._tts.generate_bytes, text)
+            except Exception:
+                traceback.print_exc()
+                return None
+
+    async def _send_in_order(self) -> None:
+        task: Optional[asyncio.Task[Optional[bytes]]] = None
+        try:
+            while True:
+                task = await self._synthesis_tasks.get()
+                if task is None:
+                    break
+
+                sound_data = await task
+                if sound_data is None:
+                    continue
+
+                await self._send_audio(self._utterance, self._sequence, sound_data)
+                self._sequence += 1
+
+            await self._send_audio(self._utterance, self._sequence, None)
+
+        finally:
+            # Do not leave synthesis running if sending failed or was cancelled
+            if task is not None:
+                task.cancel()
+            while not self._synthesis_tasks.empty():
+                task = self._synthesis_tasks.get_nowait()
+                if task is not None:
+                    task.cancel()
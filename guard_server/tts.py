@@ -1,32 +1,68 @@
 import json
 import os
+import threading
+import time
+import traceback
+from typing import List, Optional
 
 import aliyunsdkcore.client
 import aliyunsdkcore.request
 import requests
+import requests.adapters
+from tts_cache import TtsCache, make_tts_cache_key
+
+# Seconds before its expiry at which the token is created again, and the
+# minimum interval between attempts, e.g. after a failed one
+TOKEN_REFRESH_MARGIN = 600
+TOKEN_RETRY_INTERVAL = 60
+
+SENTENCE_DELIMITERS = "。！？；!?;\n"
 
 
 class TTS:
-    def __init__(self):
-        self.client = aliyunsdkcore.client.AcsClient(
-            os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
-            os.getenv("ALIBABA_CLOUD_ACCESS_KEY_SECRET"),
-            "cn-shanghai",
+    def __init__(
+        self,
+        voice: str = "xiaoyun",
+        audio_format: str = "mp3",
+        cache: Optional[TtsCache] = None,
+        max_connections: int = 4,
+    ):
+        self._voice = voice
+        self._audio_format = audio_format
+        self._cache = cache
+
+        # All instances share one token, so short-lived ones cost nothing
+        self._token_provider = get_shared_token_provider()
+
+        # Connections to the TTS gateway are kept alive and reused, so that
+        # only the first request pays for the TLS handshake
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_connections
+            ),
         )
 
+    def close(self) -> None:
+        self._session.close()
+
     def generate(self, text: str, output_path: str) -> None:
-        request = aliyunsdkcore.request.CommonRequest()
-        request.set_method("POST")
-        request.set_domain("nls-meta.cn-shanghai.aliyuncs.com")
-        request.set_version("2019-02-28")
-        request.set_action_name("CreateToken")
+        audio = self.generate_bytes(text)
 
-        response = self.client.do_action_with_exception(request)
-        assert isinstance(response, bytes)
-        jss = json.loads(response.decode())
-        token = jss["Token"]["Id"]
+        with open(output_path, "wb") as f:
+            f.write(audio)
+
+    def generate_bytes(self, text: str) -> bytes:
+        cache_key = make_tts_cache_key(text, self._voice, self._audio_format)
+        if self._cache is not None:
+            audio = self._cache.get(cache_key)
+            if audio is not None:
+                return audio
 
-        response = requests.post(
+        token = self._token_provider.get_token()
+
+        response = self._session.post(
             "https://nls-gateway-cn-shanghai.aliyuncs.com/stream/v1/tts",
             headers={"Content-Type": "application/json"},
             data=json.dumps(
@@ -34,10 +70,116 @@ def generate(self, text: str, output_path: str) -> None:
                     "appkey": os.getenv("NLS_APP_KEY"),
                     "text": text,
                     "token": token,
-                    "format": "mp3",
+                    "format": self._audio_format,
+                    "voice": self._voice,
                 }
             ),
         )
 
-        with open(output_path, "wb") as f:
-            f.write(response.content)
+        # Errors are returned as JSON, which must not be taken for audio
+        if not response.headers.get("Content-Type", "").startswith("audio/"):
+            raise RuntimeError(f"TTS failed: {response.text}")
+
+        if self._cache is not None:
+            self._cache.put(cache_key, response.content)
+
+        return response.content
+
+
+class NlsTokenProvider:
+    def __init__(self):
+        self._client = aliyunsdkcore.client.AcsClient(
+            os.getenv("ALIBABA_CLOUD_ACCESS_KEY_ID"),
+            os.getenv("ALIBABA_CLOUD_ACCESS_KEY_SECRET"),
+            "cn-shanghai",
+        )
+
+        # The token is valid for hours, so it is only created again shortly
+        # before it expires, in the background
+        self._token: Optional[str] = None
+        self._token_expire_time: float = 0
+        self._token_lock = threading.Lock()
+        threading.Thread(target=self._token_refresh_thread_func, daemon=True).start()
+
+    def get_token(self) -> str:
+        with self._token_lock:
+            if (
+                self._token is None
+                or time.time() >= self._token_expire_time - TOKEN_REFRESH_MARGIN
+            ):
+                self._refresh_token()
+
+            assert self._token is not None
+            return self._token
+
+    def _refresh_token(self) -> None:
+        # Must be called with the token lock held
+        request = aliyunsdkcore.request.CommonRequest()
+        request.set_method("POST")
+        request.set_domain("nls-meta.cn-shanghai.aliyuncs.com")
+        request.set_version("2019-02-28")
+        request.set_action_name("CreateToken")
+
+        response = self._client.do_action_with_exception(request)
+        assert isinstance(response, bytes)
+        jss = json.loads(response.decode())
+        self._token = jss["Token"]["Id"]
+        self._token_expire_time = float(jss["Token"]["ExpireTime"])
+
+    def _token_refresh_thread_func(self) -> None:
+        while True:
+            try:
+                self.get_token()
+                delay = max(
+                    self._token_expire_time - TOKEN_REFRESH_MARGIN - time.time(),
+                    TOKEN_RETRY_INTERVAL,
+                )
+
+            except Exception:
+                traceback.print_exc()
+                delay = TOKEN_RETRY_INTERVAL
+
+            time.sleep(delay)
+
+
+_shared_token_provider: Optional[NlsTokenProvider] = None
+_shared_token_provider_lock = threading.Lock()
+
+
+def get_shared_token_provider() -> NlsTokenProvider:
+    # Created on first use, so that importing the module starts no thread
+    global _shared_token_provider
+
+    with _shared_token_provider_lock:
+        if _shared_token_provider is None:
+            _shared_token_provider = NlsTokenProvider()
+
+        return _shared_token_provider
+
+
+class SentenceSplitter:
+    # Splits text that arrives in pieces into chunks that end at sentence
+    # boundaries, so that each chunk can be synthesized on its own. Sentences
+    # shorter than min_length are joined with the next one, as every chunk
+    # costs a request.
+    def __init__(self, min_length: int = 8):
+        self._min_length = min_length
+        self._buffer: str = ""
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+
+        chunks: List[str] = []
+        start = 0
+        for i, c in enumerate(self._buffer):
+            if c in SENTENCE_DELIMITERS and i + 1 - start >= self._min_length:
+                chunks.append(self._buffer[start : i + 1])
+                start = i + 1
+
+        self._buffer = self._buffer[start:]
+        return [chunk for chunk in chunks if not chunk.isspace()]
+
+    def flush(self) -> List[str]:
+        chunk = self._buffer
+        self._buffer = ""
+        return [] if len(chunk) == 0 or chunk.isspace() else [chunk]
@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Optional, OrderedDict, TypedDict
+
+
+class TtsCacheStats(TypedDict):
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    memory_bytes: int
+    disk_bytes: int
+
+
+class TtsCache:
+    # Keeps synthesized audio in memory and, if a directory is given, on disk
+    # so that it survives restarts. Both tiers evict the least recently used
+    # audio when they exceed their size in bytes.
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        max_memory_bytes: int = 16 * 1024 * 1024,
+        max_disk_bytes: int = 256 * 1024 * 1024,
+    ):
+        self._directory = directory
+        self._max_memory_bytes = max_memory_bytes
+        self._max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+
+        # Ordered from least to most recently used
+        self._memory_entries: OrderedDict[str, bytes] = collections.OrderedDict()
+        self._memory_bytes: int = 0
+        self._disk_entries: OrderedDict[str, int] = collections.OrderedDict()
+        self._disk_bytes: int = 0
+
+        self._memory_hits: int = 0
+        self._disk_hits: int = 0
+        self._misses: int = 0
+
+        if self._directory is not None:
+            os.makedirs(self._directory, exist_ok=True)
+            self._load_disk_entries()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory_entries.get(key)
+            if data is not None:
+                self._memory_entries.move_to_end(key)
+                self._memory_hits += 1
+                return data
+
+            if key not in self._disk_entries:
+                self._misses += 1
+                return None
+
+            self._disk_entries.move_to_end(key)
+            self._disk_hits += 1
+
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+
+            # The modification time orders the files after a restart
+            os.utime(path)
+
+        except FileNotFoundError:
+            return None
+
+        with self._lock:
+            self._put_in_memory(key, data)
+
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        with self._lock:
+            self._put_in_memory(key, data)
+
+        if self._directory is None or key in self._disk_entries:
+            return
+
+        # Written atomically, so that a crash cannot leave truncated audio. The
+        # same key may be put by several threads at once, so each writes its
+        # own temporary file.
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self._directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self._get_path(key))
+
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        with self._lock:
+            # Only the first of concurrent puts of the key accounts for it
+            if key in self._disk_entries:
+                return
+
+            self._disk_entries[key] = len(data)
+            self._disk_bytes += len(data)
+
+            evicted_keys = []
+            while self._disk_bytes > self._max_disk_bytes:
+                evicted_key, size = self._disk_entries.popitem(last=False)
+                self._disk_bytes -= size
+                evicted_keys.append(evicted_key)
+
+        for evicted_key in evicted_keys:
+            try:
+                os.remove(self._get_path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def get_stats(self) -> TtsCacheStats:
+        with self._lock:
+            return {
+                "memory_hits": self._memory_hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _put_in_memory(self, key: str, data: bytes) -> None:
+        # Must be called with the lock held
+        previous_data = self._memory_entries.pop(key, None)
+        if previous_data is not None:
+            self._memory_bytes -= len(previous_data)
+
+        self._memory_entries[key] = data
+        self._memory_bytes += len(data)
+
+        while self._memory_bytes > self._max_memory_bytes:
+            _, evicted_data = self._memory_entries.popitem(last=False)
+            self._memory_bytes -= len(evicted_data)
+
+    def _load_disk_entries(self) -> None:
+        assert self._directory is not None
+
+        files = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith(".tmp"):
+                os.remove(entry.path)
+                continue
+
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, key, size in sorted(files):
+            self._disk_entries[key] = size
+            self._disk_bytes += size
+
+    def _get_path(self, key: str) -> str:
+        assert self._directory is not None
+        return os.path.join(self._directory, key)
+
+
+def make_tts_cache_key(text: str, voice: str, audio_format: str) -> str:
+    content = json.dumps([text, voice, audio_format], ensure_ascii=False)
+    return hashlib.sha256(content.encode()).hexdigest() + "." + audio_format
@@ -27,13 +27,13 @@ def main() -> None:
                 timestamp=time.asctime(), message=complete_message))
             sensor_report = SensorReport(
                 endpoint="sensor_client",
-                messageId="1",
+                messageId="SensorReport",
                 sensorType="Environment",
                 sensorDescription="Environment data of temperature, humidity, light, human presence, illumination, and pressure.",
                 data=parse_message(
                     timestamp=time.asctime(), message=complete_message),
             )
-            comm.send("sensor", str(sensor_report))
+            comm.send("sensor/Environment", json.dumps(sensor_report))
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,17 @@
-from typing import Any, TypedDict
+from typing import Any, Dict, List, NotRequired, TypedDict
+
+
+class AttachmentInfo(TypedDict):
+    name: str
+    contentType: str
 
 
 class ActuatorCommand(TypedDict):
     endpoint: str
     messageId: str
     data: Any
+    # Describes the binary frames sent after the message, in order
+    attachments: NotRequired[List[AttachmentInfo]]
 
 
 class ActuatorRegistration(TypedDict):
@@ -21,3 +28,34 @@ class SensorReport(TypedDict):
     sensorType: str
     sensorDescription: str
     data: Any
+    # Describes the binary frames sent after the message, in order
+    attachments: NotRequired[List[AttachmentInfo]]
+
+
+class QuestionManifestEntry(TypedDict):
+    question: str
+    order: int
+    sha256: str
+
+
+class QuestionManifest(TypedDict):
+    endpoint: str
+    messageId: str
+    # The sound of each question prompt, identified by its content hash
+    questions: List[QuestionManifestEntry]
+
+
+class QuestionSoundRequest(TypedDict):
+    endpoint: str
+    messageId: str
+    # Hashes of the sounds to send, or none to send the manifest again
+    sha256s: List[str]
+
+
+class CommStats(TypedDict):
+    # Name of the publishing comm
+    endpoint: str
+    messageId: str
+    # Stats of the receive queue of each subscribed channel, including the
+    # messages dropped because the subscriber did not keep up
+    channels: Dict[str, Any]
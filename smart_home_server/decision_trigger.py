@@ -0,0 +1,86 @@
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from info_db import InfoDb, InfoDbEntry
+
+
+class DecisionTrigger:
+    def __init__(
+        self,
+        info_db: InfoDb,
+        endpoints: Optional[Iterable[str]] = None,
+        debounce: float = 0.3,
+        max_delay: float = 2.0,
+        normalize: Optional[Callable[[InfoDbEntry], Any]] = None,
+    ):
+        self._info_db = info_db
+
+        # Only changes of these endpoints trigger a decision, or of any
+        # endpoint if None. The decision still sees the whole InfoDb.
+        self._endpoints = None if endpoints is None else set(endpoints)
+
+        # After a relevant change, the trigger waits until no further relevant
+        # change arrives for debounce seconds, so that results landing together
+        # are decided on at once, but never longer than max_delay seconds.
+        self._debounce = debounce
+        self._max_delay = max_delay
+
+        # Entries restored from the store are as old as the store, so only
+        # changes after the trigger was created count
+        self._version: int = info_db.get_version()
+
+        # A change of an endpoint is only relevant if it changes the normalized
+        # entry, e.g. not if a sensor merely reports a new timestamp
+        self._normalize = normalize
+        self._normalized_entries: Dict[str, Any] = {}
+        if normalize is not None:
+            for entry in info_db.get():
+                self._normalized_entries[entry["endpoint"]] = normalize(entry)
+
+    async def wait(self) -> None:
+        # Changes made while the caller is deciding are kept and trigger the
+        # next call right away, so there is at most one decision in flight.
+        while not await self._wait_for_relevant_change(None):
+            pass
+
+        deadline = time.monotonic() + self._max_delay
+        while True:
+            timeout = min(self._debounce, deadline - time.monotonic())
+            if timeout <= 0:
+                return
+
+            if not await self._wait_for_relevant_change(timeout):
+                return
+
+    async def _wait_for_relevant_change(self, timeout: Optional[float]) -> bool:
+        version = await self._info_db.async_wait_for_change(
+            self._version, self._endpoints, timeout
+        )
+
+        # On timeout the version may still have moved because of irrelevant
+        # endpoints, so check which endpoints changed.
+        changed_endpoints = self._info_db.get_changed_endpoints(self._version)
+        self._version = version
+
+        # Every endpoint is checked, so that the normalized entries stay
+        # up to date
+        relevant = [
+            self._is_relevant(endpoint)
+            for endpoint in changed_endpoints
+            if self._endpoints is None or endpoint in self._endpoints
+        ]
+        return any(relevant)
+
+    def _is_relevant(self, endpoint: str) -> bool:
+        if self._normalize is None:
+            return True
+
+        entry = self._info_db.get_endpoint(endpoint)
+        normalized = None if entry is None else self._normalize(entry)
+        if endpoint in self._normalized_entries and (
+            self._normalized_entries[endpoint] == normalized
+        ):
+            return False
+
+        self._normalized_entries[endpoint] = normalized
+        return True
@@ -0,0 +1,123 @@
+import collections
+import io
+import threading
+from typing import Dict, Optional, OrderedDict, Tuple, TypedDict
+
+import PIL.Image
+from frame_store import Frame
+
+# Left, top, right and bottom edges of a region as fractions of the size of the
+# frame
+Region = Tuple[float, float, float, float]
+
+
+class ImageVariantSpec(TypedDict):
+    # Longest edge in pixels of the uploaded image
+    max_edge: int
+    jpeg_quality: int
+    # Whether the image is cropped to the region of interest, if one is given
+    crop_roi: bool
+    # Margin added around the region of interest, as a fraction of its size
+    roi_margin: float
+
+
+class ImageVariantStats(TypedDict):
+    requests: int
+    original_bytes: int
+    variant_bytes: int
+
+
+class ImagePreprocessor:
+    # Produces the image each consumer uploads for a frame, which is as small
+    # as its spec allows. Variants are computed once per frame and spec, and
+    # kept for the latest max_frames frames.
+    def __init__(self, specs: Dict[str, ImageVariantSpec], max_frames: int = 4):
+        self._specs = specs
+        self._max_frames = max_frames
+
+        # Ordered from the oldest to the newest frame
+        self._variants: OrderedDict[int, Dict[Tuple, bytes]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._stats: Dict[str, ImageVariantStats] = {
+            consumer: {"requests": 0, "original_bytes": 0, "variant_bytes": 0}
+            for consumer in specs
+        }
+
+    def get_variant(
+        self, frame: Frame, consumer: str, roi: Optional[Region] = None
+    ) -> bytes:
+        spec = self._specs[consumer]
+        key = tuple(spec.values()) + (roi if spec["crop_roi"] else None,)
+
+        with self._lock:
+            variant = self._variants.get(frame["sequence"], {}).get(key)
+
+        if variant is None:
+            variant = make_variant(frame["data"], spec, roi)
+
+            with self._lock:
+                self._variants.setdefault(frame["sequence"], {})[key] = variant
+                while len(self._variants) > self._max_frames:
+                    self._variants.popitem(last=False)
+
+        with self._lock:
+            stats = self._stats[consumer]
+            stats["requests"] += 1
+            stats["original_bytes"] += len(frame["data"])
+            stats["variant_bytes"] += len(variant)
+
+        return variant
+
+    def get_stats(self) -> Dict[str, ImageVariantStats]:
+        with self._lock:
+            return {consumer: stats.copy() for consumer, stats in self._stats.items()}
+
+
+def make_variant(img: bytes, spec: ImageVariantSpec, roi: Optional[Region]) -> bytes:
+    # Returns the original image if it cannot be decoded, or if it is already
+    # smaller than the variant would be
+    crop = spec["crop_roi"] and roi is not None
+
+    try:
+        with PIL.Image.open(io.BytesIO(img)) as image:
+            # Lets the JPEG decoder downscale while decoding, as long as the
+            # result is still at least twice the size needed. A cropped region
+            # needs the full resolution.
+            if not crop:
+                image.draft("RGB", (spec["max_edge"] * 2, spec["max_edge"] * 2))
+            variant = image.convert("RGB")
+
+    except (OSError, ValueError):
+        return img
+
+    cropped = False
+    if crop:
+        assert roi is not None
+        left, top, right, bottom = roi
+        margin_x = (right - left) * spec["roi_margin"]
+        margin_y = (bottom - top) * spec["roi_margin"]
+        box = (
+            int(max(left - margin_x, 0.0) * variant.width),
+            int(max(top - margin_y, 0.0) * variant.height),
+            int(min(right + margin_x, 1.0) * variant.width),
+            int(min(bottom + margin_y, 1.0) * variant.height),
+        )
+        if box[2] > box[0] and box[3] > box[1]:
+            variant = variant.crop(box)
+            cropped = True
+
+    resized = max(variant.size) > spec["max_edge"]
+    if resized:
+        variant.thumbnail(
+            (spec["max_edge"], spec["max_edge"]), PIL.Image.Resampling.LANCZOS
+        )
+
+    output = io.BytesIO()
+    variant.save(output, "JPEG", quality=spec["jpeg_quality"], optimize=True)
+    variant_data = output.getvalue()
+
+    if not cropped and not resized and len(variant_data) >= len(img):
+        return img
+
+    return variant_data
@@ -1,21 +1,378 @@
-from typing import Any, Dict, List, Optional, TypedDict
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NotRequired,
+    Optional,
+    Sequence,
+    Tuple,
+    TypedDict,
+)
+
+import numpy as np
+from info_db_store import InfoDbStore, Snapshot
+
+# Numeric fields of sensor reports, as produced by bt_serial.parse_message of
+# the sensor client, which are recorded when history is enabled.
+DEFAULT_HISTORY_FIELDS: List[str] = [
+    "Temperature",
+    "Humidity",
+    "LightStrength",
+    "Pressure",
+]
 
 
 class InfoDbEntry(TypedDict):
     endpoint: str
     description: str
     data: Any
+    # Sequence number of the camera frame the data was analyzed from
+    sequence: NotRequired[int]
+
+
+class TrendSummary(TypedDict):
+    samples: int
+    mean: float
+    min: float
+    max: float
+    slope_per_minute: float
 
 
 class InfoDb:
-    def __init__(self):
+    def __init__(
+        self,
+        history_size: Optional[int] = None,
+        history_fields: Sequence[str] = DEFAULT_HISTORY_FIELDS,
+        store: Optional[InfoDbStore] = None,
+    ):
         self._info: Dict[str, InfoDbEntry] = {}
 
-    def insert(self, entry: InfoDbEntry):
-        self._info[entry["endpoint"]] = entry
+        # Computed endpoints are evaluated when the content is read rather than
+        # inserted, and their owner marks them as changed when it matters.
+        self._computed_endpoints: Dict[str, Tuple[str, Callable[[], Any]]] = {}
+
+        # If history_size is set, numeric history_fields of the inserted data
+        # are kept in a fixed-size ring buffer per endpoint.
+        self._history_size = history_size
+        self._history_fields = list(history_fields)
+        self._histories: Dict[str, RingBuffer] = {}
+
+        # The version is increased on every insert that changes the content of
+        # an endpoint, and the endpoint remembers the version of its last
+        # change, so consumers can tell what changed since they last looked.
+        self._version: int = 0
+        self._endpoint_versions: Dict[str, int] = {}
+        self._digests: Dict[str, str] = {}
+
+        self._condition = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+        # Changes are written to the store in the background, and the content
+        # of the store is restored on startup.
+        self._store = store
+        if self._store is not None:
+            self._version, entries = self._store.load()
+            for entry in entries:
+                self._info[entry["endpoint"]] = entry
+                self._digests[entry["endpoint"]] = compute_digest(entry)
+                self._endpoint_versions[entry["endpoint"]] = self._version
+
+            self._store.start(self._get_snapshot)
+
+    def close(self) -> None:
+        if self._store is not None:
+            self._store.close()
+
+    def insert(self, entry: InfoDbEntry) -> bool:
+        return self.insert_many([entry])
+
+    def insert_many(self, entries: Sequence[InfoDbEntry]) -> bool:
+        # The entries that change their endpoint share a single new version, so
+        # consumers never see some of them without the others. Returns whether
+        # any endpoint changed.
+        digests = [compute_digest(entry) for entry in entries]
+
+        with self._condition:
+            changed_entries: List[Tuple[InfoDbEntry, str]] = []
+            for entry, digest in zip(entries, digests):
+                endpoint = entry["endpoint"]
+                self._info[endpoint] = entry
+
+                if self._history_size is not None:
+                    self._record_history(endpoint, entry["data"])
+
+                if self._digests.get(endpoint) != digest:
+                    changed_entries.append((entry, digest))
+
+            if len(changed_entries) == 0:
+                return False
+
+            self._version += 1
+            for entry, digest in changed_entries:
+                self._digests[entry["endpoint"]] = digest
+                self._endpoint_versions[entry["endpoint"]] = self._version
+
+                if self._store is not None:
+                    self._store.append(self._version, entry)
+
+            async_waiters = self._take_waiters()
+
+        wake_async_waiters(async_waiters)
+
+        return True
+
+    def register_computed_endpoint(
+        self, endpoint: str, description: str, compute: Callable[[], Any]
+    ) -> None:
+        with self._condition:
+            self._computed_endpoints[endpoint] = (description, compute)
+
+            # An entry that was inserted before, e.g. restored from the store,
+            # would be shadowed by the computed one
+            self._info.pop(endpoint, None)
+            self._digests.pop(endpoint, None)
+
+        self.mark_changed(endpoint)
+
+    def mark_changed(self, endpoint: str) -> None:
+        with self._condition:
+            self._version += 1
+            self._endpoint_versions[endpoint] = self._version
+            async_waiters = self._take_waiters()
+
+        wake_async_waiters(async_waiters)
 
     def get(self) -> List[InfoDbEntry]:
-        return list(self._info.values())
+        with self._condition:
+            info = list(self._info.values())
+            computed_endpoints = list(self._computed_endpoints.items())
+
+        return info + [
+            {"endpoint": endpoint, "description": description, "data": compute()}
+            for endpoint, (description, compute) in computed_endpoints
+        ]
 
     def get_endpoint(self, endpoint: str) -> Optional[InfoDbEntry]:
-        return self._info.get(endpoint)
+        with self._condition:
+            entry = self._info.get(endpoint)
+            computed_endpoint = self._computed_endpoints.get(endpoint)
+
+        if computed_endpoint is not None:
+            description, compute = computed_endpoint
+            return {"endpoint": endpoint, "description": description, "data": compute()}
+
+        return entry
+
+    def get_version(self) -> int:
+        with self._condition:
+            return self._version
+
+    def get_digest(self, endpoint: str) -> Optional[str]:
+        with self._condition:
+            return self._digests.get(endpoint)
+
+    def get_changed_endpoints(self, since_version: int) -> List[str]:
+        with self._condition:
+            return [
+                endpoint
+                for endpoint, version in self._endpoint_versions.items()
+                if version > since_version
+            ]
+
+    def get_trends(
+        self, window_seconds: float, endpoints: Optional[Iterable[str]] = None
+    ) -> Dict[str, Dict[str, TrendSummary]]:
+        now = time.time()
+
+        with self._condition:
+            return {
+                endpoint: history.summarize(now - window_seconds)
+                for endpoint, history in self._histories.items()
+                if endpoints is None or endpoint in endpoints
+            }
+
+    def wait_for_change(
+        self,
+        since_version: int,
+        endpoints: Optional[Iterable[str]] = None,
+        timeout: Optional[float] = None,
+    ) -> int:
+        # Returns the current version, which is unchanged on timeout and can be
+        # passed as since_version of the next call.
+        endpoint_set = None if endpoints is None else set(endpoints)
+
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._has_changed(since_version, endpoint_set), timeout
+            )
+            return self._version
+
+    async def async_wait_for_change(
+        self,
+        since_version: int,
+        endpoints: Optional[Iterable[str]] = None,
+        timeout: Optional[float] = None,
+    ) -> int:
+        endpoint_set = None if endpoints is None else set(endpoints)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self._condition:
+                if self._has_changed(since_version, endpoint_set):
+                    return self._version
+
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(future, remaining)
+            except TimeoutError:
+                return self.get_version()
+
+    def _get_snapshot(self) -> Snapshot:
+        with self._condition:
+            return self._version, list(self._info.values())
+
+    def _take_waiters(self) -> List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]:
+        # Must be called with the condition held
+        self._condition.notify_all()
+        async_waiters = self._async_waiters
+        self._async_waiters = []
+
+        return async_waiters
+
+    def _record_history(self, endpoint: str, data: Any) -> None:
+        values = extract_numeric_fields(data, self._history_fields)
+        if values is None:
+            return
+
+        history = self._histories.get(endpoint)
+        if history is None:
+            assert self._history_size is not None
+            history = RingBuffer(self._history_size, self._history_fields)
+            self._histories[endpoint] = history
+
+        history.append(time.time(), values)
+
+    def _has_changed(self, since_version: int, endpoints: Optional[set]) -> bool:
+        if self._version <= since_version:
+            return False
+
+        if endpoints is None:
+            return True
+
+        return any(
+            self._endpoint_versions.get(endpoint, 0) > since_version
+            for endpoint in endpoints
+        )
+
+
+class RingBuffer:
+    def __init__(self, size: int, fields: Sequence[str]):
+        self._fields = list(fields)
+
+        # Preallocated so memory use does not grow with uptime, NaN marks
+        # missing values
+        self._timestamps = np.full(size, np.nan)
+        self._values = np.full((size, len(fields)), np.nan)
+        self._next_index: int = 0
+
+    def append(self, timestamp: float, values: np.ndarray) -> None:
+        self._timestamps[self._next_index] = timestamp
+        self._values[self._next_index] = values
+        self._next_index = (self._next_index + 1) % len(self._timestamps)
+
+    def summarize(self, since: float) -> Dict[str, TrendSummary]:
+        in_window = self._timestamps >= since
+        timestamps = self._timestamps[in_window]
+        values = self._values[in_window]
+
+        valid = ~np.isnan(values)
+        samples = valid.sum(axis=0)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(valid, values, 0).sum(axis=0) / samples
+            minimum = np.where(valid, values, np.inf).min(axis=0, initial=np.inf)
+            maximum = np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf)
+
+            # Least-squares slope of value over time, per field
+            time_offsets = np.where(valid, timestamps[:, np.newaxis], 0)
+            mean_time = time_offsets.sum(axis=0) / samples
+            time_deviations = np.where(valid, time_offsets - mean_time, 0)
+            value_deviations = np.where(valid, values - mean, 0)
+            slope = (time_deviations * value_deviations).sum(axis=0) / (
+                time_deviations**2
+            ).sum(axis=0)
+
+        summaries: Dict[str, TrendSummary] = {}
+        for i, field in enumerate(self._fields):
+            if samples[i] == 0:
+                continue
+
+            summaries[field] = {
+                "samples": int(samples[i]),
+                "mean": round(float(mean[i]), 2),
+                "min": round(float(minimum[i]), 2),
+                "max": round(float(maximum[i]), 2),
+                "slope_per_minute": (
+                    round(float(slope[i]) * 60, 4) if np.isfinite(slope[i]) else 0.0
+                ),
+            }
+
+        return summaries
+
+
+def extract_numeric_fields(data: Any, fields: Sequence[str]) -> Optional[np.ndarray]:
+    # Sensor clients report their data as a JSON string with string values
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return None
+
+    if not isinstance(data, dict):
+        return None
+
+    values = np.full(len(fields), np.nan)
+    for i, field in enumerate(fields):
+        try:
+            values[i] = float(data[field])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    if np.isnan(values).all():
+        return None
+
+    return values
+
+
+def compute_digest(entry: InfoDbEntry) -> str:
+    # A new frame with the same analysis result does not change the endpoint
+    content = json.dumps(
+        {key: value for key, value in entry.items() if key != "sequence"},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def wake_async_waiters(
+    async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]],
+) -> None:
+    for loop, future in async_waiters:
+        loop.call_soon_threadsafe(resolve_future, future)
+
+
+def resolve_future(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -21,6 +21,12 @@
 {sensors}
 ```
 
+传感器数值近期趋势（样本数、均值、最小值、最大值、每分钟变化率）：
+
+```
+{trends}
+```
+
 事件：
 
 ```
@@ -58,7 +64,9 @@ class LLMResponse(TypedDict):
 
 
 class LLM:
-    def generate(self, actuators: str, sensors: str, event: str) -> LLMResponse:
+    def generate(
+        self, actuators: str, sensors: str, event: str, trends: str = "{}"
+    ) -> LLMResponse:
         messages = [
             {
                 "role": "system",
@@ -66,7 +74,9 @@ def generate(self, actuators: str, sensors: str, event: str) -> LLMResponse:
             },
             {
                 "role": "user",
-                "content": PROMPT_USER_TEMPLATE.format(sensors=sensors, event=event),
+                "content": PROMPT_USER_TEMPLATE.format(
+                    sensors=sensors, trends=trends, event=event
+                ),
             },
         ]
 
@@ -1,52 +1,160 @@
+import asyncio
 import base64
-import datetime
-import hashlib
+import functools
 import json
 import os
-import threading
-import time
-from typing import List
+import traceback
+from typing import Dict, List, Set
 
 import alibabacloud_facebody20191230.models
-import holidays
-from communication import ZmqComm
+from calendar_info import CalendarInfo, ChangeGranularity
+from communication import AsyncZmqComm
+from decision_cache import DecisionCache
+from decision_trigger import DecisionTrigger
+from frame_pipeline import FramePipeline, decode_frame, select_informative_frames
+from frame_store import Frame, FrameStore
+from image_preprocessor import ImagePreprocessor, ImageVariantSpec
 from info_db import InfoDb, InfoDbEntry
-from llm import LLM
+from info_db_store import InfoDbStore
+from llm import LLM, LLMResponse
+from motion_gate import MotionGate, is_presence_reported
+from perceptual_hash import PerceptualHashCache
 from schemas import ActuatorCommand, ActuatorRegistration, SensorReport
-from vlm import VLM
+from vlm import VLM, VLMResponse
 
 COMM_BROKER_HOST = "10.8.0.5"
 COMM_BROKER_BACKEND_PORT = 5556
 COMM_BROKER_FRONTEND_PORT = 5555
 
+# Samples of numeric sensor fields kept per endpoint, and the window in
+# seconds over which their trends are summarized for the LLM
+HISTORY_SIZE = 720
+TREND_WINDOW = 600
+
+# Endpoints whose changes trigger a new decision, and the debounce window in
+# seconds in which changes are collected into a single decision. Sensors report
+# continuously, so the window is longer than for the guard.
+LLM_TRIGGER_ENDPOINTS = {"Environment", "calendar", "vlm"}
+LLM_TRIGGER_DEBOUNCE = 1.0
+LLM_TRIGGER_MAX_DELAY = 5.0
+
+# The calendar endpoint changes every hour, as the time of day matters for
+# e.g. the lights
+CALENDAR_CHANGE_GRANULARITY: ChangeGranularity = "hour"
+
+# Decisions are reused for situations that look the same, for at most
+# DECISION_CACHE_TTL seconds. Endpoints in DECISION_CACHE_UNCACHED_ENDPOINTS
+# opt out of the cache.
+DECISION_CACHE_SIZE = 256
+DECISION_CACHE_TTL = 600.0
+DECISION_CACHE_UNCACHED_ENDPOINTS: Set[str] = set()
+
+# Latest camera frames kept in memory, and the minimum seconds between two
+# analyses of frames by the frame pipeline
+FRAME_STORE_CAPACITY = 8
+FRAME_ANALYSIS_MIN_INTERVAL = 5.0
+
+# Frames are downscaled to at most max_edge pixels and re-encoded before they
+# are uploaded by the VLM stage
+IMAGE_UPLOAD_SPECS: Dict[str, ImageVariantSpec] = {
+    "vlm": {"max_edge": 1024, "jpeg_quality": 80, "crop_roi": False, "roi_margin": 0.0},
+}
+
+# The VLM stage analyzes frames at most once per VLM_BATCH_INTERVAL seconds,
+# and sends up to VLM_BATCH_SIZE frames of that interval which differ the most
+# in a single request, so that it sees how the scene developed. A
+# VLM_BATCH_SIZE of 1 only sends the latest frame.
+VLM_BATCH_SIZE = 3
+VLM_BATCH_INTERVAL = 10.0
+
+# Results of the VLM stage kept per perceptual hash of the analyzed frame, and
+# how many bits the hash of a frame may differ to reuse them
+VISION_CACHE_SIZE = 128
+VISION_CACHE_MAX_DISTANCE = 6
+
+# Frames only reach the VLM stage if at least MOTION_MIN_CHANGED_FRACTION of
+# their pixels changed by more than MOTION_PIXEL_THRESHOLD since the last frame
+# that did, or if the environment sensor reports a person present and
+# MOTION_GATE_USE_PRESENCE is set
+MOTION_MIN_CHANGED_FRACTION = 0.02
+MOTION_PIXEL_THRESHOLD = 25
+MOTION_GATE_USE_PRESENCE = True
+
+# Seconds between printing the counters of the pipeline stages
+STATS_INTERVAL = 60
+
+# Seconds to wait before a task carries on after a failure, e.g. of a cloud
+# service
+TASK_RETRY_DELAY = 5
+
+# Directory where the state of the server is persisted across restarts
+DATA_DIR = "data"
+
 DEFAULT_INFO: List[InfoDbEntry] = []
 
-info_db = InfoDb()
-actuator_db = InfoDb()
-comm = ZmqComm(
+info_db = InfoDb(
+    history_size=HISTORY_SIZE,
+    store=InfoDbStore(os.path.join(DATA_DIR, "info_db")),
+)
+actuator_db = InfoDb(store=InfoDbStore(os.path.join(DATA_DIR, "actuator_db")))
+frame_store = FrameStore(capacity=FRAME_STORE_CAPACITY)
+frame_pipeline = FramePipeline(
+    frame_store,
+    info_db,
+    min_interval=FRAME_ANALYSIS_MIN_INTERVAL,
+    motion_gate=MotionGate(MOTION_MIN_CHANGED_FRACTION, MOTION_PIXEL_THRESHOLD),
+    # Looked up on call, as the function is defined below
+    is_person_present=lambda: is_person_present(),
+)
+# Keeps the variants of all stored frames, which the VLM stage may send
+image_preprocessor = ImagePreprocessor(
+    IMAGE_UPLOAD_SPECS, max_frames=FRAME_STORE_CAPACITY
+)
+# Frames that look like an analyzed one reuse its result
+vlm_cache: PerceptualHashCache[VLMResponse] = PerceptualHashCache(
+    max_size=VISION_CACHE_SIZE, max_distance=VISION_CACHE_MAX_DISTANCE
+)
+comm = AsyncZmqComm(
     broker_host=COMM_BROKER_HOST,
     broker_backend_port=COMM_BROKER_BACKEND_PORT,
     broker_frontend_port=COMM_BROKER_FRONTEND_PORT,
+    name="smart_home_server",
 )
 
 
-def main() -> None:
-    comm.connect()
+async def main() -> None:
+    await comm.connect()
     comm.register_receive_callback("sensor", sensor_comm_callback)
-    comm.register_receive_callback("actuator", actuator_registration_callback)
+    # Only the latest camera frame is of interest
+    comm.register_receive_callback(
+        "sensor/camera",
+        sensor_comm_callback,
+        max_queue_size=1,
+        overflow_policy="drop_oldest",
+    )
+    comm.register_receive_callback(
+        "actuator/registration", actuator_registration_callback
+    )
 
     for entry in DEFAULT_INFO:
         info_db.insert(entry)
 
-    thread_list: List[threading.Thread] = [
-        threading.Thread(target=calendar_thread),
-        threading.Thread(target=llm_thread),
-        threading.Thread(target=vlm_thread),
-    ]
-    for thread in thread_list:
-        thread.start()
-
-def actuator_registration_callback(msg_str: str) -> None:
+    try:
+        # If any task fails, the others are cancelled
+        async with asyncio.TaskGroup() as task_group:
+            task_group.create_task(calendar_task())
+            task_group.create_task(frame_task())
+            task_group.create_task(llm_task())
+            task_group.create_task(stats_task())
+
+    finally:
+        await comm.disconnect()
+        info_db.close()
+        actuator_db.close()
+
+async def actuator_registration_callback(
+    msg_str: str, attachments: List[memoryview]
+) -> None:
     msg = json.loads(msg_str)
     if msg["messageId"] != "ActuatorRegistration":
         return
@@ -59,7 +167,7 @@ def actuator_registration_callback(msg_str: str) -> None:
         "data": msg["commandFormatDescription"],
     })
 
-def sensor_comm_callback(msg_str: str) -> None:
+async def sensor_comm_callback(msg_str: str, attachments: List[memoryview]) -> None:
     msg = json.loads(msg_str)
     if msg["messageId"] != "SensorReport":
         return
@@ -68,9 +176,17 @@ def sensor_comm_callback(msg_str: str) -> None:
 
     match msg["sensorType"]:
         case "camera":
-            base64_img = str(msg["data"]).encode()
-            with open("img.jpg", "wb") as f:
-                f.write(base64.decodebytes(base64_img))
+            if len(attachments) > 0:
+                img = attachments[0]
+            else:
+                # Legacy cameras send the image as base64 in the data field
+                img = memoryview(base64.decodebytes(str(msg["data"]).encode()))
+
+            # Copied once out of the received message, and shared with all
+            # consumers from then on
+            img_data = bytes(img)
+            dhash, thumbnail = await asyncio.to_thread(decode_frame, img_data)
+            frame_store.put(img_data, dhash, thumbnail)
 
         case _:
             info_db.insert(
@@ -82,93 +198,157 @@ def sensor_comm_callback(msg_str: str) -> None:
             )
 
 
-def calendar_thread() -> None:
+async def calendar_task() -> None:
+    calendar_info = CalendarInfo(granularity=CALENDAR_CHANGE_GRANULARITY)
+
+    info_db.register_computed_endpoint(
+        "calendar",
+        "本系统用于获取当前时间和日期信息",
+        calendar_info.get_data,
+    )
+
     while True:
-        time.sleep(1)
-
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y-%m-%d")
-        holidays_cn = holidays.country_holidays("CN")
-        holiday_name = holidays_cn.get(date_str)
-        info_db.insert(
-            {
-                "endpoint": "calendar",
-                "description": "本系统用于获取当前时间和日期信息",
-                "data": {
-                    "date_time": now.strftime("%Y-%m-%d %I%p %A"),
-                    "holiday": holiday_name or "无节日",
-                },
-            }
-        )
+        await asyncio.sleep(calendar_info.get_seconds_until_next_change())
 
-def llm_thread() -> None:
+        info_db.mark_changed("calendar")
+
+async def llm_task() -> None:
     llm = LLM()
 
-    last_info_hash: int = 0
+    decision_cache: DecisionCache[LLMResponse] = DecisionCache(
+        max_size=DECISION_CACHE_SIZE,
+        ttl=DECISION_CACHE_TTL,
+        uncached_endpoints=DECISION_CACHE_UNCACHED_ENDPOINTS,
+    )
+
+    trigger = DecisionTrigger(
+        info_db,
+        endpoints=LLM_TRIGGER_ENDPOINTS,
+        debounce=LLM_TRIGGER_DEBOUNCE,
+        max_delay=LLM_TRIGGER_MAX_DELAY,
+        normalize=decision_cache.normalize_entry,
+    )
 
     while True:
-        time.sleep(5)
+        await trigger.wait()
+
+        # A failed decision is not retried for the same situation, and the
+        # delay bounds the rate of failing requests
+        try:
+            await decide(llm, decision_cache)
+        except Exception:
+            traceback.print_exc()
+            await asyncio.sleep(TASK_RETRY_DELAY)
+
 
-        info = json.dumps(info_db.get(), sort_keys=True)
-        info_hash = hash(info)
-        if info_hash == last_info_hash:
-            print("No new info")
-            continue
-        last_info_hash = info_hash
+async def decide(llm: LLM, decision_cache: DecisionCache[LLMResponse]) -> None:
+    frame_analysis = frame_pipeline.get_latest_analysis()
+    if frame_analysis is not None:
+        print(f"Deciding on frame {frame_analysis['sequence']}")
 
-        actuator_commands = actuator_db.get()
+    info_entries = info_db.get()
 
-        llm_response = llm.generate(str(actuator_commands), info, "refresh")
+    actuator_commands = actuator_db.get()
+
+    # The decision also depends on which actuators are registered. Trends
+    # are left out of the key, as they hardly ever repeat exactly, and the
+    # TTL bounds how long they are ignored.
+    cache_key = decision_cache.make_key(info_entries, actuator_commands)
+    llm_response = decision_cache.get(cache_key)
+    if llm_response is None:
+        info = json.dumps(info_entries, sort_keys=True)
+
+        trends = json.dumps(info_db.get_trends(TREND_WINDOW), ensure_ascii=False)
+
+        llm_response = await asyncio.to_thread(
+            llm.generate, str(actuator_commands), info, "refresh", trends
+        )
+        decision_cache.put(cache_key, llm_response)
 
-        print(llm_response)
+    print(llm_response)
+    print(decision_cache.get_stats())
 
-        for actuator_command in llm_response["actuator_commands"]:
-            comm.send("actuator", json.dumps(actuator_command))
+    for actuator_command in llm_response["actuator_commands"]:
+        command: ActuatorCommand = {
+            "endpoint": actuator_command["endpoint"],
+            "messageId": "ActuatorCommand",
+            "data": actuator_command["data"],
+        }
+        await comm.send(f"actuator/{command['endpoint']}", json.dumps(command))
 
-def vlm_thread() -> None:
+async def frame_task() -> None:
     vlm = VLM()
 
-    last_img_sha256: str = ""
+    frame_pipeline.add_stage(
+        "vlm",
+        "本系统用于分析图片中的场景，以便进行环境分析",
+        functools.partial(analyze_vlm, vlm),
+        min_interval=VLM_BATCH_INTERVAL,
+    )
 
-    while True:
-        time.sleep(5)
+    await frame_pipeline.run()
 
-        if not os.path.exists("img.jpg"):
-            info_db.insert(
-                {
-                    "endpoint": "vlm",
-                    "description": "本系统用于分析图片中的场景，以便进行环境分析",
-                    "data": "缺失",
-                }
-            )
-            continue
 
-        img_hash = hash_with_sha256(open("img.jpg", "rb").read())
-        if img_hash == last_img_sha256:
-            print("No new image")
-            continue
-        last_img_sha256 = img_hash
+async def analyze_vlm(vlm: VLM, frame: Frame) -> VLMResponse:
+    frames = select_informative_frames(
+        frame,
+        frame_store.get_frames(),
+        VLM_BATCH_SIZE,
+        VLM_BATCH_INTERVAL,
+        MOTION_MIN_CHANGED_FRACTION,
+        MOTION_PIXEL_THRESHOLD,
+    )
 
-        vlm_response = vlm.generate("img.jpg")
+    # Only results of single frames are reused, as those of several frames
+    # depend on how the scene developed
+    if len(frames) == 1:
+        vlm_response = vlm_cache.get(frame["dhash"])
+        if vlm_response is not None:
+            print("Similar frame, reusing VLM result")
+            return vlm_response
 
-        print(vlm_response)
+    vlm_response = await asyncio.to_thread(generate_vlm_response, vlm, frames)
+    if len(frames) == 1:
+        vlm_cache.put(frame["dhash"], vlm_response)
+
+    print(vlm_response)
+
+    return vlm_response
 
-        info_db.insert(
-            {
-                "endpoint": "vlm",
-                "description": "本系统用于分析图片中的场景，以便进行环境分析",
-                "data": vlm_response,
-            }
-        )
 
+def generate_vlm_response(vlm: VLM, frames: List[Frame]) -> VLMResponse:
+    return vlm.generate_frames(
+        [
+            (frame["sequence"], image_preprocessor.get_variant(frame, "vlm"))
+            for frame in frames
+        ]
+    )
+
+
+async def stats_task() -> None:
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+
+        print(
+            json.dumps(
+                {
+                    # Drops show subscriptions that do not keep up
+                    "comm": comm.get_channel_stats(),
+                    "frame_pipeline": frame_pipeline.get_stats(),
+                    "image_preprocessor": image_preprocessor.get_stats(),
+                    "vlm_cache": vlm_cache.get_stats(),
+                }
+            )
+        )
 
-def hash_with_sha256(data: bytes):
-    sha256 = hashlib.sha256()
 
-    sha256.update(data)
+def is_person_present() -> bool:
+    if not MOTION_GATE_USE_PRESENCE:
+        return False
 
-    return sha256.hexdigest()
+    entry = info_db.get_endpoint("Environment")
+    return entry is not None and is_presence_reported(entry["data"])
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import json
+from typing import Any, Optional, TypedDict
+
+import numpy as np
+import PIL.Image
+
+
+class MotionGateStats(TypedDict):
+    passed_motion: int
+    passed_presence: int
+    skipped: int
+
+
+class MotionGate:
+    # Lets a frame pass to an expensive stage only if it differs noticeably
+    # from the last frame that passed, or if a person is reported present. A
+    # pixel of the thumbnails counts as changed if its brightness differs by
+    # more than pixel_threshold, and the frame if more than
+    # min_changed_fraction of the pixels did.
+    def __init__(self, min_changed_fraction: float = 0.02, pixel_threshold: int = 25):
+        self._min_changed_fraction = min_changed_fraction
+        self._pixel_threshold = pixel_threshold
+
+        self._reference: Optional[np.ndarray] = None
+
+        self._passed_motion: int = 0
+        self._passed_presence: int = 0
+        self._skipped: int = 0
+
+    def should_pass(self, thumbnail: Optional[np.ndarray], presence: bool) -> bool:
+        if (
+            thumbnail is None
+            or self._reference is None
+            or thumbnail.shape != self._reference.shape
+        ):
+            self._reference = thumbnail
+            self._passed_motion += 1
+            return True
+
+        changed = np.abs(thumbnail - self._reference) > self._pixel_threshold
+        if np.mean(changed) >= self._min_changed_fraction:
+            self._reference = thumbnail
+            self._passed_motion += 1
+            return True
+
+        if presence:
+            self._reference = thumbnail
+            self._passed_presence += 1
+            return True
+
+        self._skipped += 1
+        return False
+
+    def get_stats(self) -> MotionGateStats:
+        return {
+            "passed_motion": self._passed_motion,
+            "passed_presence": self._passed_presence,
+            "skipped": self._skipped,
+        }
+
+
+def compute_image_thumbnail(image: PIL.Image.Image, size: int = 64) -> np.ndarray:
+    # Small version of the grayscale image for frame differencing, which evens
+    # out sensor noise
+    thumbnail = image.resize((size, size), PIL.Image.Resampling.BILINEAR)
+    return np.asarray(thumbnail, dtype=np.int16)
+
+
+def is_presence_reported(data: Any) -> bool:
+    # Environment sensors report the ManExists field of bt_serial.parse_message
+    # of the sensor client in a JSON string
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return False
+
+    if not isinstance(data, dict):
+        return False
+
+    return str(data.get("ManExists", "0")).strip() not in ("0", "")
@@ -0,0 +1,82 @@
+import collections
+from typing import Generic, Optional, OrderedDict, Tuple, TypedDict, TypeVar
+
+import numpy as np
+import PIL.Image
+
+T = TypeVar("T")
+
+
+class PerceptualHashCacheStats(TypedDict):
+    hits: int
+    misses: int
+    size: int
+
+
+class PerceptualHashCache(Generic[T]):
+    # Maps perceptual hashes of frames to the results of their analysis, so
+    # that frames which look the same as an analyzed one, i.e. whose hashes
+    # differ in at most max_distance bits, reuse its result.
+    def __init__(self, max_size: int = 128, max_distance: int = 6):
+        self._max_size = max_size
+        self._max_distance = max_distance
+
+        # Ordered from least to most recently used
+        self._entries: OrderedDict[int, T] = collections.OrderedDict()
+
+        self._hits: int = 0
+        self._misses: int = 0
+
+    def get(self, perceptual_hash: Optional[int]) -> Optional[T]:
+        if perceptual_hash is None:
+            return None
+
+        closest: Optional[Tuple[int, int]] = None
+        for cached_hash in self._entries:
+            distance = hamming_distance(perceptual_hash, cached_hash)
+            if distance <= self._max_distance and (
+                closest is None or distance < closest[0]
+            ):
+                closest = (distance, cached_hash)
+
+        if closest is None:
+            self._misses += 1
+            return None
+
+        self._entries.move_to_end(closest[1])
+        self._hits += 1
+        return self._entries[closest[1]]
+
+    def put(self, perceptual_hash: Optional[int], result: T) -> None:
+        if perceptual_hash is None:
+            return
+
+        self._entries[perceptual_hash] = result
+        self._entries.move_to_end(perceptual_hash)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def get_stats(self) -> PerceptualHashCacheStats:
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+            "size": len(self._entries),
+        }
+
+
+def compute_image_dhash(image: PIL.Image.Image, hash_size: int = 8) -> int:
+    # Difference hash of the grayscale image, with one bit per horizontally
+    # adjacent pair of pixels of a hash_size x hash_size thumbnail telling
+    # whether the brightness increases. Sensor noise and re-encoding hardly
+    # change it.
+    thumbnail = image.resize((hash_size + 1, hash_size), PIL.Image.Resampling.BILINEAR)
+
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
@@ -1,6 +1,7 @@
 import json
 import os
-from typing import List, TypedDict
+import tempfile
+from typing import List, NotRequired, Sequence, Tuple, TypedDict
 
 import dashscope
 import dashscope.api_entities
@@ -39,24 +40,106 @@
 """
 
 
+# Appended to the prompt of requests with several frames
+MULTI_FRAME_PROMPT = """
+以上{count}张图片是同一摄像头按时间先后顺序拍摄的画面，编号依次为1到{count}。
+请结合图片之间的变化进行推理，例如人物的出现、离开和动作。
+
+除上述字段外，你的JSON回复还必须包含以下字段：
+
+```
+{{
+    "frames": [
+        {{
+            "frame": 图片编号,
+            "description": "该图片相比前一张图片的变化和值得关注的细节"
+        }},
+        ...
+    ]
+}}
+```
+"""
+
+
+class VLMFrameReference(TypedDict):
+    # Sequence number of the frame in the frame store
+    sequence: int
+    description: str
+
+
 class VLMResponse(TypedDict):
     reasoning: str
     description: str
     statements: List[str]
     questions: List[str]
+    # Only in responses to requests with several frames
+    frames: NotRequired[List[VLMFrameReference]]
 
 
 class VLM:
+    def generate_bytes(self, img: bytes) -> VLMResponse:
+        # The SDK uploads images from files, so the image is written to a
+        # temporary file that only this call uses
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+            f.write(img)
+            f.flush()
+
+            return self.generate(f.name)
+
+    def generate_frames(self, frames: Sequence[Tuple[int, bytes]]) -> VLMResponse:
+        # Analyzes several frames, given as pairs of sequence number and image
+        # in chronological order, in a single request
+        if len(frames) == 1:
+            return self.generate_bytes(frames[0][1])
+
+        temp_files = []
+        try:
+            for _, img in frames:
+                f = tempfile.NamedTemporaryFile(suffix=".jpg")
+                temp_files.append(f)
+                f.write(img)
+                f.flush()
+
+            result = self._call(
+                [f.name for f in temp_files],
+                PROMPT + MULTI_FRAME_PROMPT.format(count=len(frames)),
+            )
+
+        finally:
+            for f in temp_files:
+                f.close()
+
+        # The model refers to the frames by their position in the request
+        references: List[VLMFrameReference] = []
+        for reference in result.get("frames", []):
+            try:
+                index = int(reference["frame"]) - 1
+                description = str(reference["description"])
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            if 0 <= index < len(frames):
+                references.append(
+                    {"sequence": frames[index][0], "description": description}
+                )
+
+        result["frames"] = references
+
+        return result
+
     def generate(self, img_path: str) -> VLMResponse:
-        abs_path = os.path.abspath(img_path)
-        image_url = f"file://{abs_path}"
+        return self._call([img_path], PROMPT)
 
+    def _call(self, img_paths: List[str], prompt: str) -> VLMResponse:
         messages = [
             {
                 "role": "user",
                 "content": [
-                    {"image": image_url},
-                    {"text": PROMPT},
+                    *(
+                        {"image": f"file://{os.path.abspath(img_path)}"}
+                        for img_path in img_paths
+                    ),
+                    {"text": prompt},
                 ],
             },
         ]
@@ -1,14 +1,15 @@
-import base64
 import hashlib
 import json
 import os
+import queue
 import random
-from typing import List, TypedDict
+import threading
+from typing import List, Optional, Tuple, TypedDict
 import playsound
 from schemas import SensorReport
 
 from comm import ZmqComm
-from schemas import ActuatorCommand
+from schemas import ActuatorCommand, QuestionManifest, QuestionSoundRequest
 
 COMM_BROKER_HOST = "home.server.futrime.com"
 COMM_BROKER_BACKEND_PORT = 5556
@@ -32,23 +33,32 @@
     broker_host=COMM_BROKER_HOST,
     broker_backend_port=COMM_BROKER_BACKEND_PORT,
     broker_frontend_port=COMM_BROKER_FRONTEND_PORT,
+    name="sound_client",
 )
 
-class Explanation(TypedDict):
-    sound: str
-
 class Question(TypedDict):
     order: int
     question: str
-    sound: str
 
 asking_question = False
 
+# Chunks of explanations as (utterance, file name), played one after another by
+# the player thread so that the next chunk is ready when the previous one ends
+explanation_queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+latest_utterance: Optional[str] = None
+
 def main() -> None:
     global asking_question
 
+    threading.Thread(target=explanation_player_thread_func, daemon=True).start()
+
     comm.connect()
-    comm.register_receive_callback("actuator", actuator_comm_callback)
+    comm.register_receive_callback("actuator/question", actuator_comm_callback)
+    comm.register_receive_callback("actuator/explanation", actuator_comm_callback)
+
+    # The manifest is usually replayed by the broker, but ask in case the
+    # broker has restarted since it was published
+    request_question_sounds([])
 
     while True:
         input("Enter to start asking question")
@@ -61,9 +71,7 @@ def main() -> None:
         for order in range(3):
             question = questions[order]
 
-            file_name = hash_with_sha256(
-                (QUESTION_ORDER_PREFIX_LIST[order] + question).encode("utf-8")
-            ) + ".mp3"
+            file_name = get_question_file_name(order, question)
 
             playsound.playsound(file_name)
 
@@ -79,15 +87,19 @@ def main() -> None:
             "data": qa_dict,
         }
 
-        comm.send("sensor", json.dumps(message))
+        comm.send("sensor/question_answer", json.dumps(message))
 
         asking_question = False
 
 
-def actuator_comm_callback(msg_str: str) -> None:
+def actuator_comm_callback(msg_str: str, attachments: List[memoryview]) -> None:
     global asking_question
 
     msg = json.loads(msg_str)
+    if msg["messageId"] == "QuestionManifest":
+        receive_question_manifest(msg)
+        return
+
     if msg["messageId"] != "ActuatorCommand":
         return
 
@@ -95,36 +107,95 @@ def actuator_comm_callback(msg_str: str) -> None:
         return
 
     if msg["endpoint"] == "explanation":
-        data_explanation: Explanation = msg["data"]
-        sound = data_explanation["sound"].encode("utf-8")
-        with open("sound.mp3", "wb") as f:
-            f.write(base64.decodebytes(sound))
-
-        if asking_question:
-            return
-
-        playsound.playsound("sound.mp3")
-
+        receive_explanation_chunk(msg["data"], attachments)
         return
 
     if msg["endpoint"] == "question":
         data_question: Question = msg["data"]
         order = data_question["order"]
         question = data_question["question"]
-        sound = data_question["sound"].encode("utf-8")
 
-        file_name = hash_with_sha256(
-            (QUESTION_ORDER_PREFIX_LIST[order] + question).encode("utf-8")
-        ) + ".mp3"
+        file_name = get_question_file_name(order, question)
+
+        # Sounds requested by their content hash are verified against it
+        if "sha256" in msg["data"]:
+            if hash_with_sha256(attachments[0]) != msg["data"]["sha256"]:
+                print(f"Corrupted sound of question {question}")
+                return
 
-        if os.path.exists(file_name):
+        elif os.path.exists(file_name):
             return
 
-        with open(file_name, "wb") as f:
-            f.write(base64.decodebytes(sound))
+        with open(file_name + ".tmp", "wb") as f:
+            f.write(attachments[0])
+        os.replace(file_name + ".tmp", file_name)
 
         return
 
+def receive_question_manifest(manifest: QuestionManifest) -> None:
+    missing_sha256s = []
+    for entry in manifest["questions"]:
+        file_name = get_question_file_name(entry["order"], entry["question"])
+
+        if not os.path.exists(file_name):
+            missing_sha256s.append(entry["sha256"])
+            continue
+
+        with open(file_name, "rb") as f:
+            if hash_with_sha256(f.read()) != entry["sha256"]:
+                missing_sha256s.append(entry["sha256"])
+
+    if len(missing_sha256s) > 0:
+        request_question_sounds(missing_sha256s)
+
+
+def request_question_sounds(sha256s: List[str]) -> None:
+    request: QuestionSoundRequest = {
+        "endpoint": "question",
+        "messageId": "QuestionSoundRequest",
+        "sha256s": sha256s,
+    }
+
+    comm.send("request/question", json.dumps(request))
+
+
+def receive_explanation_chunk(data: dict, attachments: List[memoryview]) -> None:
+    global latest_utterance
+
+    # Explanations from older servers are sent as a single chunk
+    utterance = data.get("utterance", "")
+    sequence = data.get("sequence", 0)
+
+    # A new explanation replaces the one that is still being played
+    latest_utterance = utterance
+
+    if len(attachments) == 0 or asking_question:
+        return
+
+    file_name = f"explanation_{utterance}_{sequence}.mp3"
+    with open(file_name, "wb") as f:
+        f.write(attachments[0])
+
+    explanation_queue.put((utterance, file_name))
+
+
+def explanation_player_thread_func() -> None:
+    while True:
+        utterance, file_name = explanation_queue.get()
+
+        try:
+            if utterance == latest_utterance and not asking_question:
+                playsound.playsound(file_name)
+        finally:
+            os.remove(file_name)
+
+
+def get_question_file_name(order: int, question: str) -> str:
+    return hash_with_sha256(
+        (QUESTION_ORDER_PREFIX_LIST[order] + question).encode("utf-8")
+    ) + ".mp3"
+
+
 def hash_with_sha256(data: bytes):
     sha256 = hashlib.sha256()
 